@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+#  UNIS-RT
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+
+"""
+Attribute access micro-benchmarks.
+
+Builds a small node/port/link topology in memory and measures attribute reads
+per second through Context, from single fields up to the
+node.ports[i].link.endpoints chains walked by the graph services.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+def build(size):
+    from unis.models import Node, Port, Link
+    nodes = [Node({"id": "n{}".format(i), "name": "n{}".format(i)}) for i in range(size)]
+    for i, n in enumerate(nodes):
+        src, dst = Port({"id": "p{}a".format(i)}), Port({"id": "p{}b".format(i)})
+        link = Link({"id": "l{}".format(i), "directed": False, "endpoints": [src, dst]})
+        src.link, dst.link = link, link
+        src.node, dst.node = n, nodes[(i + 1) % size]
+        n.ports.append(src)
+        nodes[(i + 1) % size].ports.append(dst)
+    return nodes
+
+def run(name, fn, nodes, repeat, reads):
+    start = time.time()
+    for _ in range(repeat):
+        for n in nodes:
+            fn(n)
+    elapsed = max(time.time() - start, 1e-9)
+    print("{:<40} {:>12.0f} reads/s".format(name, (reads * repeat * len(nodes)) / elapsed))
+
+def main(size, repeat):
+    nodes = build(size)
+    run("node.name", lambda n: n.name, nodes, repeat, 1)
+    run("node.getCollection", lambda n: n.getCollection, nodes, repeat, 1)
+    run("node.ports[0]", lambda n: n.ports[0], nodes, repeat, 2)
+    run("node.ports[0].link", lambda n: n.ports[0].link, nodes, repeat, 3)
+    run("node.ports[0].link.endpoints[1].node", lambda n: n.ports[0].link.endpoints[1].node, nodes, repeat, 6)
+    run("node.ports[0].link.endpoints[1].node.name", lambda n: n.ports[0].link.endpoints[1].node.name, nodes, repeat, 7)
+    run("for p in node.ports: p.link", lambda n: [p.link for p in n.ports], nodes, repeat, 5)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark attribute access on resource chains")
+    parser.add_argument("-n", "--size", type=int, default=1000, help="Number of nodes in the topology")
+    parser.add_argument("-r", "--repeat", type=int, default=20, help="Passes over the topology per benchmark")
+    args = parser.parse_args()
+    try:
+        main(args.size, args.repeat)
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
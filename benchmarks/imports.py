@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+#  UNIS-RT
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+
+"""
+Import time of the runtime.
+
+Imports unis in a fresh interpreter several times and reports the median
+time spent in `import unis`, the time to generate every model class in
+settings.SCHEMAS and the number of schema requests made.  Third party
+packages are imported before the clock starts so only runtime code is
+measured.  Point RTUSER_ROOT at an empty directory to measure a cold cache;
+every run after the first uses the warm cache.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CHILD = """
+import json, os, sys, time
+import aiohttp, jsonschema, requests, websockets
+calls, _get = [], requests.get
+requests.get = lambda *args, **kwargs: calls.append(args[0]) or _get(*args, **kwargs)
+start = time.perf_counter()
+import unis
+loaded = time.perf_counter()
+import unis.models
+for n in unis.settings.SCHEMAS:
+    getattr(unis.models, n)
+done = time.perf_counter()
+print(json.dumps({"import": loaded - start, "classes": done - loaded, "requests": len(calls)}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+def main(repeat):
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", CHILD], env=os.environ)
+        runs.append(json.loads(out.decode().strip().splitlines()[-1]))
+    ms = lambda k: statistics.median([r[k] for r in runs]) * 1000
+    print("runs:          {}".format(repeat))
+    print("import unis:   {:.1f} ms (median)".format(ms("import")))
+    print("all classes:   {:.1f} ms (median)".format(ms("classes")))
+    print("requests:      {} first run, {} last run".format(runs[0]["requests"], runs[-1]["requests"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark runtime import time")
+    parser.add_argument("-r", "--repeat", type=int, default=10, help="Number of interpreters to start")
+    args = parser.parse_args()
+    try:
+        main(args.repeat)
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
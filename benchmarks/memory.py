@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+#  UNIS-RT
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+
+"""
+Memory footprint of runtime metadata.
+
+Loads N nodes into a collection through UnisCollection.append and reports the
+resident set size, the cost of reading runtime attributes and how much memory
+is returned once the collection is dropped.  Run against two revisions to
+compare storage strategies.
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import weakref
+
+def rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def main(count, host):
+    from unis.models import Node
+    from unis.models.lists import UnisCollection
+    from unis.rest.unis_client import UnisClient
+    UnisClient.fqdns[host] = "benchmark"
+
+    gc.collect()
+    base = rss()
+    collection = UnisCollection("nodes", Node)
+    start = time.time()
+    for i in range(count):
+        n = Node({"id": str(i), "selfRef": "http://{}/nodes/{}".format(host, i), "name": "n{}".format(i)})
+        collection.append(n.getObject())
+    load = time.time() - start
+    loaded = rss()
+
+    start = time.time()
+    for item in collection._cache:
+        item._rt_parent, item._rt_collection, item._rt_remote
+    lookup = time.time() - start
+
+    refs = [weakref.ref(x) for x in collection._cache[:1000]]
+    del collection, n, item
+    gc.collect()
+
+    print("nodes:        {}".format(count))
+    print("load:         {:.2f}s".format(load))
+    print("rss (loaded): {:.1f} MiB (+{:.1f} MiB)".format(loaded, loaded - base))
+    print("rss (freed):  {:.1f} MiB".format(rss()))
+    print("lookup:       {:.0f} reads/s".format(3 * count / max(lookup, 1e-9)))
+    print("released:     {}/{} sampled objects".format(sum(1 for r in refs if r() is None), len(refs)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark runtime metadata storage")
+    parser.add_argument("-n", "--count", type=int, default=1000000, help="Number of nodes to load")
+    parser.add_argument("--host", type=str, default="localhost:8888", help="Authority used for node selfRefs")
+    args = parser.parse_args()
+    try:
+        main(args.count, args.host)
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+#  UNIS-RT
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+
+"""
+Page sizing against a local mock UNIS.
+
+Starts two mock UNIS instances on localhost, a near one and a far one, each
+answering `GET /nodes?id=...` after a fixed round trip plus a per record
+cost.  Every paging mode then streams the same set of stubs from both and
+reports the time to the first record and to the last, and per source the
+requests made, the slowest round trip and the final page size.
+"""
+
+import aiohttp
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from aiohttp import web
+
+def mock_unis(name, rtt, per_record, size):
+    docs = { str(i): { "$schema": "", "id": str(i), "selfRef": "http://{}/nodes/{}".format(name, i),
+                       "name": "node-{}".format(i), "description": "x" * size } for i in range(100000) }
+    async def nodes(request):
+        ids = request.query.get("id", "").split(",")
+        await asyncio.sleep(rtt + per_record * len(ids))
+        return web.Response(text=json.dumps([docs[i] for i in ids if i in docs]), content_type="application/json")
+    app = web.Application()
+    app.router.add_get("/nodes", nodes)
+    return app
+
+async def serve(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+def run(mode, ports, count, args):
+    from unis.models import Node
+    from unis.models.lists import UnisCollection
+    from unis.settings import SCHEMAS
+    col = UnisCollection("nodes", Node)
+    col._paging = { "mode": mode, "size": 10, "growth": 2, "limit": args.limit, "latency": args.latency, "payload": args.payload }
+    col._pagers, col._pushdown = {}, False
+    async def connect():
+        return aiohttp.ClientSession()
+    session = col._loop.run_until_complete(connect())
+    async def get(source, **kwargs):
+        url = "http://127.0.0.1:{}/nodes".format(ports[source[0]])
+        async with session.get(url, params={ "id": ",".join(kwargs["id"]) }) as resp:
+            result = await resp.json()
+        for r in result:
+            r["$schema"] = SCHEMAS["Node"]
+        return result
+    col._unis.get, col._unis.refToUID = get, lambda ref: (ref.split('/')[2], ("nodes", ref.split('/')[-1]))
+    col._stubs.update({ (s, ("nodes", str(i))): None for s in ports for i in range(count) })
+    start, first = time.perf_counter(), None
+    for _ in col.stream():
+        first = first or time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    col._loop.run_until_complete(session.close())
+    per = lambda s,v: "{}: {:>4} requests, slowest {:.3f} s, page {:>4}".format(s, v["requests"], v["slowest"], v["page"])
+    print("{:<12} first {:.3f} s  all {:>6.2f} s  {}".format(mode, first, elapsed, "  ".join(per(s,v) for s,v in sorted(col.stats().items()))))
+
+def main(args):
+    loop = asyncio.get_event_loop()
+    servers = { "near": mock_unis("near", args.rtt, args.cost, args.bytes), "far": mock_unis("far", args.rtt * 8, args.cost, args.bytes) }
+    ports = {}
+    for name, app in servers.items():
+        runner, ports[name] = loop.run_until_complete(serve(app))
+    for mode in ["fixed", "exponential", "adaptive"]:
+        run(mode, ports, args.count, args)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark collection page sizing against a mock UNIS")
+    parser.add_argument("-n", "--count", type=int, default=5000, help="Resources per mock instance")
+    parser.add_argument("--rtt", type=float, default=0.01, help="Round trip time of the near instance in seconds, the far one is 8x")
+    parser.add_argument("--cost", type=float, default=0.0002, help="Server time per record in seconds")
+    parser.add_argument("--bytes", type=int, default=200, help="Padding per record in bytes")
+    parser.add_argument("--limit", type=int, default=1000, help="Largest page requested")
+    parser.add_argument("--latency", type=float, default=0.1, help="Adaptive target round trip time in seconds")
+    parser.add_argument("--payload", type=int, default=1048576, help="Adaptive target payload in bytes")
+    args = parser.parse_args()
+    try:
+        main(args)
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
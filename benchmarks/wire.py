@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+#  UNIS-RT
+#
+#  Copyright (c) 2012-2016, Trustees of Indiana University,
+#  All rights reserved.
+#
+#  This software may be modified and distributed under the terms of the BSD
+#  license.  See the COPYING file for details.
+#
+#  This software was created at the Indiana University Center for Research in
+#  Extreme Scale Technologies (CREST).
+# =============================================================================
+
+"""
+Wire format throughput against a local mock UNIS.
+
+Starts a mock UNIS on localhost serving a large `nodes` collection and a large
+`data` collection.  Each is pre-encoded as JSON, gzip-JSON and BSON, and the
+format is picked from the request's Accept and Accept-Encoding headers the way
+a negotiating server would.  Every format is then pulled through UnisClient
+and the time, records per second and bytes on the wire are reported, along
+with plain JSON decoded record by record as it streams in.
+"""
+
+import argparse
+import asyncio
+import bson
+import gzip
+import json
+import os
+import sys
+import time
+
+from aiohttp import web
+
+def mock_unis(nodes, data):
+    bodies = {}
+    for name, docs in [("nodes", nodes), ("data", data)]:
+        text = json.dumps(docs).encode('utf-8')
+        bodies[name] = { "json": text, "gzip": gzip.compress(text, 6), "bson": bson.dumps({ str(i): d for i,d in enumerate(docs) }) }
+    sent = { "bytes": 0 }
+    def handler(name):
+        async def get(request):
+            if "bson" in request.headers.get("Accept", ""):
+                body, headers = bodies[name]["bson"], { "Content-Type": "application/perfsonar+bson" }
+            elif "gzip" in request.headers.get("Accept-Encoding", ""):
+                body, headers = bodies[name]["gzip"], { "Content-Type": "application/perfsonar+json", "Content-Encoding": "gzip" }
+            else:
+                body, headers = bodies[name]["json"], { "Content-Type": "application/perfsonar+json" }
+            sent["bytes"] += len(body)
+            return web.Response(body=body, headers=headers)
+        return get
+    app = web.Application()
+    app.router.add_get("/nodes", handler("nodes"))
+    app.router.add_get("/data/m", handler("data"))
+    return app, sent
+
+async def serve(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+def client(port, wire, compress, stream):
+    from unis.rest.unis_client import UnisClient, _PoolStats
+    c = object.__new__(UnisClient)
+    c._url, c._verify, c._ssl = "http://127.0.0.1:{}".format(port), False, None
+    c._threads, c._batch, c._limits, c._sessions = 4, 1000, {}, {}
+    c._pool, c._stats = { "size": 4, "keepalive": 30, "dns_ttl": 300 }, _PoolStats()
+    c._wire, c._compress, c._stream = wire, compress, stream
+    return c
+
+def main(args):
+    from unis.codec import codec
+    print("codec {}".format(codec.use(args.codec)))
+    loop = asyncio.get_event_loop()
+    nodes = [{ "$schema": "http://unis.crest.iu.edu/schema/20160630/node#", "id": str(i), "ts": i * 1000000,
+               "selfRef": "http://localhost:8888/nodes/{}".format(i), "name": "node-{}".format(i),
+               "description": "x" * args.bytes, "ports": [{ "href": "http://localhost:8888/ports/{}".format(i), "rel": "full" }] }
+             for i in range(args.count)]
+    data = [{ "ts": 1500000000000000 + i, "value": float(i) * 0.5 } for i in range(args.count * 4)]
+    app, sent = mock_unis(nodes, data)
+    runner, port = loop.run_until_complete(serve(app))
+    modes = [("json", False, None, "json"), ("json", False, 0, "json-stream"), ("json", True, None, "gzip-json"), ("bson", False, None, "bson")]
+    for wire, compress, stream, label in modes:
+        c = client(port, wire, compress, stream)
+        for name in ["nodes", "data/m"]:
+            loop.run_until_complete(c.get(name))
+            best, sent["bytes"] = None, 0
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                records = len(loop.run_until_complete(c.get(name)))
+                best = min(best or float("inf"), time.perf_counter() - start)
+            print("{:<12} {:<7} {:>7} records  {:>7.3f} s  {:>10.0f} records/s  {:>8.2f} MB on the wire".format(
+                label, name.split('/')[0], records, best, records / best, sent["bytes"] / args.repeat / 1048576))
+        for session in c._sessions.values():
+            loop.run_until_complete(session.close())
+    loop.run_until_complete(runner.cleanup())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON, gzip-JSON and BSON pulls against a mock UNIS")
+    parser.add_argument("-n", "--count", type=int, default=50000, help="Nodes served, data holds four times as many records")
+    parser.add_argument("--bytes", type=int, default=100, help="Padding per node in bytes")
+    parser.add_argument("-c", "--codec", type=str, default="auto", help="JSON codec, see unis.codec")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Pulls per format, the fastest is reported")
+    args = parser.parse_args()
+    try:
+        main(args)
+    finally:
+        sys.stdout.flush()
+        os._exit(0)
@@ -1,2 +1,2 @@
 from unis import settings
-from unis.runtime import Runtime
+from unis.runtime import AsyncRuntime, Runtime
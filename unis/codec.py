@@ -0,0 +1,44 @@
+import json
+
+from collections import OrderedDict
+
+from unis.settings import ConfigurationError
+
+def _stdlib():
+    return json.dumps, lambda v: json.loads(v if isinstance(v, str) else str(v, 'utf-8'))
+def _orjson():
+    import orjson
+    def dumps(v):
+        try:
+            return orjson.dumps(v).decode('utf-8')
+        except TypeError:
+            # Values orjson refuses, such as integers past 64 bits
+            return json.dumps(v)
+    return dumps, orjson.loads
+def _ujson():
+    import ujson
+    return lambda v: ujson.dumps(v, escape_forward_slashes=False), ujson.loads
+
+class _Codec(object):
+    """
+    JSON encoder and decoder used on the wire.  `use("auto")` picks the fastest
+    backend installed, `loads` accepts bytes or str.
+    """
+    BACKENDS = OrderedDict([("orjson", _orjson), ("ujson", _ujson), ("json", _stdlib)])
+    def __init__(self):
+        self.use("auto")
+
+    def use(self, name):
+        name = name or "auto"
+        if name != "auto" and name not in self.BACKENDS:
+            raise ConfigurationError("Unknown JSON codec - {}".format(name))
+        for n in (self.BACKENDS if name == "auto" else [name]):
+            try:
+                self.dumps, self.loads = self.BACKENDS[n]()
+                self.name = n
+                return n
+            except ImportError:
+                if name != "auto":
+                    raise ConfigurationError("JSON codec not installed - {}".format(name))
+
+codec = _Codec()
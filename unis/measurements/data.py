@@ -60,7 +60,7 @@ class DataCollection(object):
         self._len, self._fn, self._rt = 0, [], rt
         self._at = 0 if rt.settings["measurements"]["read_history"] else int(time.time() * 1000000)
         if not rt.settings["measurements"]["subscribe"]:
-            self._subscribe = lambda: False
+            self._subscribe = self._unsubscribed
         list(map(lambda f: self.attachFunction(f[0], f[1]), (fns or {}).items()))
     @trace.info("DataCollection")
     def attachFunction(self, fn, name="", doc=""):
@@ -79,23 +79,26 @@ class DataCollection(object):
         for f in self._fn:
             f.prior = f.apply(float(record['value']), record['ts'])
     @trace.debug("DataCollection")
-    def _subscribe(self):
+    async def _subscribe(self):
         def cb(v, action):
             sets = list(v.values())
             for s in sets:
                 list(map(self._process, s))
-        future = self._rt.metadata._unis.subscribe(self._source, cb, self._href)
-        asyncio.get_event_loop().run_until_complete(future)
-        self._subscribe = lambda: True
+        await self._rt.metadata._unis.subscribe(self._source, cb, self._href)
+        self._subscribe = self._subscribed
+        return False
+    async def _subscribed(self):
+        return True
+    async def _unsubscribed(self):
         return False
     
     @trace.info("DataCollection")
     def load(self):
-        if not self._subscribe():
+        asyncio.get_event_loop().run_until_complete(self.aload())
+    @trace.info("DataCollection")
+    async def aload(self):
+        if not await self._subscribe():
             kwargs = { "sort": "ts:1", "ts": "gt={}".format(self._at) }
-            future = self._rt.metadata._unis.get(self._source, ref=self._href, **kwargs)
-            data = asyncio.get_event_loop().run_until_complete(future)
+            data = await self._rt.metadata._unis.get(self._source, ref=self._href, **kwargs)
             list(map(self._process, data))
             self._at = int(time.time() * 1000000)
-
-
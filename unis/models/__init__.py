@@ -1,15 +1,31 @@
-import os
 import sys
+import types
 
 from unis import settings
 
 from unis.models.models import _SchemaCache
 schemaLoader = _SchemaCache()
 
-# Ensure cache includes hyper-schema
-schemaLoader.get_class("http://json-schema.org/draft-04/schema#", 'draft4-schema', True)
-schemaLoader.get_class("http://json-schema.org/draft-04/hyper-schema#", 'draft4-hyper-schema', True)
-schemaLoader.get_class("http://json-schema.org/draft-04/links#", 'draft4-links', True)
+METASCHEMAS = {
+    'draft4-schema':       "http://json-schema.org/draft-04/schema#",
+    'draft4-hyper-schema': "http://json-schema.org/draft-04/hyper-schema#",
+    'draft4-links':        "http://json-schema.org/draft-04/links#"
+}
 
-for name, schema in settings.SCHEMAS.items():
-    setattr(sys.modules[__name__], name, schemaLoader.get_class(schema))
+# Model classes are generated on first access, e.g. `from unis.models import Node`
+class _LazyModels(types.ModuleType):
+    def __getattr__(self, n):
+        if n not in settings.SCHEMAS:
+            raise AttributeError("module '{}' has no attribute '{}'".format(self.__name__, n))
+        if not schemaLoader._CLASSES:
+            # Ensure cache includes hyper-schema
+            for name, schema in METASCHEMAS.items():
+                schemaLoader.get_class(schema, name, True)
+        cls = schemaLoader.get_class(settings.SCHEMAS[n])
+        setattr(self, n, cls)
+        return cls
+
+    def __dir__(self):
+        return sorted(set(super(_LazyModels, self).__dir__()) | set(settings.SCHEMAS.keys()))
+
+sys.modules[__name__].__class__ = _LazyModels
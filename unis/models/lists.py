@@ -1,20 +1,342 @@
 import asyncio
+import collections
+import functools
+import heapq
 import itertools
 import math
+import re
+import threading
 import types
 
 from collections import defaultdict
+from lace import logging
 from lace.logging import trace
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 
-from unis.utils import Events, Index
+from unis.codec import codec
+from unis.utils import Events, Index, resolver
 from unis.models import schemaLoader
 from unis.models.models import Context as oContext
-from unis.rest import UnisProxy, UnisReferenceError
+from unis.rest import UnisError, UnisProxy, UnisReferenceError
+from unis.rest.unis_client import _Payload
 
-class _sparselist(list):
+def _locked(fn):
+    # Write-behind flushes and subscriptions touch collections from the proxy's thread
+    @functools.wraps(fn)
+    def _wrapper(self, *args, **kwargs):
+        with self._lock:
+            return fn(self, *args, **kwargs)
+    return _wrapper
+
+class _slotmap(object):
+    """
+    Record storage addressed by stable slot numbers.  Freed slots are reused
+    lowest first and the live count is kept so len() never scans the slots.
+    """
+    def __init__(self):
+        self._items, self._free, self._live = [], [], 0
+    
+    def add(self, item):
+        if self._free:
+            i = heapq.heappop(self._free)
+            self._items[i] = item
+        else:
+            i = len(self._items)
+            self._items.append(item)
+        self._live += 1
+        return i
+    def discard(self, i):
+        if self._items[i] is not None:
+            self._items[i] = None
+            heapq.heappush(self._free, i)
+            self._live -= 1
+    def compact(self):
+        mapping, items = {}, []
+        for i, v in self.items():
+            mapping[i] = len(items)
+            items.append(v)
+        self._items, self._free = items, []
+        return mapping
+    
+    def items(self):
+        return ((i, v) for i, v in enumerate(self._items) if v is not None)
+    def slots(self):
+        return len(self._items)
+    def holes(self):
+        return len(self._free)
+    def index(self, item):
+        return self._items.index(item)
+    
+    def __getitem__(self, i):
+        return self._items[i]
+    def __iter__(self):
+        return (v for v in self._items if v is not None)
+    def __contains__(self, item):
+        return item is not None and item in self._items
+    def __len__(self):
+        return self._live
+    def __repr__(self):
+        return list(self).__repr__()
+
+class _stubmap(dict):
+    """ Maps resource uids to their records, None while unloaded, counting the unloaded """
+    def __init__(self, *args, **kwargs):
+        super(_stubmap, self).__init__()
+        self.missing = 0
+        self.update(*args, **kwargs)
+    def __setitem__(self, k, v):
+        if k in self:
+            self.missing -= not dict.__getitem__(self, k)
+        super(_stubmap, self).__setitem__(k, v)
+        self.missing += not v
+    def __delitem__(self, k):
+        self.missing -= not dict.__getitem__(self, k)
+        super(_stubmap, self).__delitem__(k)
+    def pop(self, k, *default):
+        if k in self:
+            self.missing -= not dict.__getitem__(self, k)
+        return super(_stubmap, self).pop(k, *default)
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+class _Query(object):
+    OPS = {
+        "gt": lambda b: lambda a: type(a) is type(b) and a > b,
+        "ge": lambda b: lambda a: type(a) is type(b) and a >= b,
+        "lt": lambda b: lambda a: type(a) is type(b) and a < b,
+        "le": lambda b: lambda a: type(a) is type(b) and a <= b,
+        "eq": lambda b: lambda a: type(a) is type(b) and a == b,
+        "ne": lambda b: lambda a: type(a) is type(b) and a == b,
+        "in": lambda b: _Query._member(b),
+        "prefix": lambda b: lambda a: type(a) is type(b) and isinstance(a, (str, bytes)) and a.startswith(b)
+    }
+    @staticmethod
+    def _member(b):
+        try:
+            values = set((type(x), x) for x in b)
+        except TypeError:
+            return lambda a: any(type(a) is type(x) and a == x for x in b)
+        def _test(a):
+            try:
+                return (type(a), a) in values
+            except TypeError:
+                return False
+        return _test
+    def __init__(self, pred):
+        self.pred = { k: (v if isinstance(v, dict) else { "eq": v }) for k,v in pred.items() }
+        self._checks = []
+        for k,ops in self.pred.items():
+            get = resolver(k)
+            for f,v in ops.items():
+                if f not in self.OPS:
+                    raise ValueError("Unknown query operator - {}".format(f))
+                self._checks.append((get, self.OPS[f](v), f == "ne"))
+    
+    def plan(self, indices, total):
+        best = (None, None, None, total)
+        for key, index in indices.items():
+            if isinstance(key, tuple):
+                if not all("eq" in self.pred.get(k, {}) for k in key):
+                    continue
+                access = [("eq", tuple(self.pred[k]["eq"] for k in key))]
+            else:
+                access = [(f,v) for f,v in self.pred.get(key, {}).items() if f != "ne"]
+            for f,v in access:
+                estimate = index.estimate(f, v)
+                if estimate < best[3]:
+                    best = (key, f, v, estimate)
+        return best
+    
+    def params(self):
+        params = {}
+        for k,ops in self.pred.items():
+            for f,v in ops.items():
+                param = self._remote(f, v)
+                if param is not None:
+                    params[k] = param
+                    break
+        return params
+    @classmethod
+    def _remote(cls, f, v):
+        # Only values the server cannot reinterpret as another type are sent
+        def _value(x):
+            if isinstance(x, bool) or not isinstance(x, (str, int, float)):
+                return None
+            if isinstance(x, str):
+                if not x or x in ["true", "false", "null"] or cls._numeric(x) or set(x) & set(",="):
+                    return None
+            return quote(str(x), safe="")
+        if f == "prefix":
+            return "reg={}".format(quote("^" + re.escape(v), safe="")) if isinstance(v, str) and v else None
+        elif f == "in":
+            values = [_value(x) for x in v] if isinstance(v, (list, tuple, set)) and v else [None]
+            return None if None in values else ",".join(values)
+        value = _value(v)
+        if value is None or (f in ["gt", "ge", "lt", "le"] and isinstance(v, str)):
+            return None
+        return { "eq": value, "ne": "not={}".format(value) }.get(f, "{}={}".format(f, value))
+    @staticmethod
+    def _numeric(x):
+        try:
+            float(x)
+            return True
+        except ValueError:
+            return False
+    
+    def __call__(self, record):
+        for get, test, negate in self._checks:
+            if any(map(test, get(record))) == negate:
+                return False
+        return True
+    def __len__(self):
+        return len(self._checks)
+
+class _Eviction(object):
+    """
+    Tracks use of cache slots and yields eviction candidates, least recently
+    used first for "lru" or least frequently used first for "lfu".
+    """
+    def __init__(self, mode, entries=None, size=None):
+        if mode not in ["lru", "lfu"]:
+            raise ValueError("Unknown cache eviction policy - {}".format(mode))
+        self.mode, self.entries, self.size = mode, entries, size
+        self._freq, self._buckets, self._bytes, self.total = {}, defaultdict(collections.OrderedDict), {}, 0
+    
+    def add(self, i, item):
+        if self.size:
+            self._bytes[i] = len(item.serialize())
+            self.total += self._bytes[i]
+        self.touch(i)
+    def touch(self, i):
+        f = self._freq.get(i, 0)
+        if f:
+            self._unlink(i, f)
+        f = 1 if self.mode == "lru" else f + 1
+        self._freq[i] = f
+        self._buckets[f][i] = True
+    def discard(self, i):
+        f = self._freq.pop(i, 0)
+        if f:
+            self._unlink(i, f)
+            self.total -= self._bytes.pop(i, 0)
+    def over(self, count=None, total=None):
+        count, total = len(self._freq) if count is None else count, self.total if total is None else total
+        return bool((self.entries and count > self.entries) or (self.size and total > self.size))
+    def victims(self):
+        for f in sorted(self._buckets):
+            yield from self._buckets[f]
+    def remap(self, mapping):
+        self._freq = { mapping[i]: f for i,f in self._freq.items() }
+        self._bytes = { mapping[i]: b for i,b in self._bytes.items() }
+        for f, slots in self._buckets.items():
+            self._buckets[f] = collections.OrderedDict((mapping[i], True) for i in slots)
+    def _unlink(self, i, f):
+        del self._buckets[f][i]
+        if not self._buckets[f]:
+            del self._buckets[f]
     def __len__(self):
-        return len(list(filter(lambda x: not isinstance(x, type(None)), self)))
+        return len(self._freq)
+
+class _Pager(object):
+    """
+    Sizes the pages requested from one source.  "fixed" keeps the initial size,
+    "exponential" multiplies it by `growth` for every page taken and "adaptive"
+    splits round trip time into overhead, taken as the fastest response seen,
+    and a per record cost, then sizes pages toward the target latency and
+    payload.
+    """
+    MODES, _ALPHA = ["fixed", "exponential", "adaptive"], 0.3
+    def __init__(self, mode="exponential", size=10, growth=2, limit=1000, latency=0.5, payload=1048576):
+        if mode not in self.MODES:
+            raise ValueError("Unknown paging mode - {}".format(mode))
+        self.mode, self.size, self.growth, self.limit = mode, size, growth, limit
+        self.latency, self.payload = latency, payload
+        self.requests, self.records, self.bytes, self.rtt, self.slowest, self.record_bytes = 0, 0, 0, None, 0, None
+        self.overhead, self.per_record = None, None
+    
+    def take(self):
+        size = max(1, min(int(self.size), self.limit))
+        if self.mode == "exponential":
+            self.size = min(self.size * self.growth, self.limit)
+        return size
+    def observe(self, count, elapsed, nbytes):
+        if not count:
+            return
+        self.requests, self.records, self.bytes = self.requests + 1, self.records + count, self.bytes + nbytes
+        self.rtt, self.slowest = self._avg(self.rtt, elapsed), max(self.slowest, elapsed)
+        self.record_bytes = self._avg(self.record_bytes, nbytes / count)
+        self.overhead = elapsed if self.overhead is None else min(self.overhead, elapsed)
+        self.per_record = self._avg(self.per_record, (elapsed - self.overhead) / count)
+        if self.mode == "adaptive":
+            # Aim for the target latency, or when overhead alone nears it, for
+            # pages where records cost as much time as the round trip
+            target = self.latency - self.overhead if self.latency > 2 * self.overhead else self.overhead
+            size = target / self.per_record if self.per_record > 0 else self.limit
+            if self.record_bytes:
+                size = min(size, self.payload / self.record_bytes)
+            self.size = max(1, min(size, count * self.growth, self.limit))
+    def stats(self):
+        return { "mode": self.mode, "page": max(1, min(int(self.size), self.limit)), "requests": self.requests,
+                 "records": self.records, "bytes": self.bytes, "rtt": self.rtt, "slowest": self.slowest, "overhead": self.overhead,
+                 "per_record": self.per_record, "record_bytes": self.record_bytes }
+    def _avg(self, old, new):
+        return new if old is None else old + self._ALPHA * (new - old)
+
+class _Stream(object):
+    """
+    Iterates a collection, sync or async, yielding cached records first and then
+    each page of stubs in the order it was requested, with at most `prefetch`
+    pages in flight per source.
+    """
+    def __init__(self, collection, prefetch, cached=True, wrap=None):
+        self._col, self._prefetch = collection, max(prefetch, 1)
+        self._wrap = wrap or (lambda v: v)
+        self._ready = collections.deque(collection._cache) if cached else collections.deque()
+        self._todo, self._inflight, self._busy = defaultdict(collections.deque), {}, defaultdict(int)
+        self._order = collections.deque()
+        for k,v in collection._stubs.items():
+            if not v:
+                self._todo[k[0]].append(k[1][1])
+    
+    def _schedule(self):
+        for source, todo in self._todo.items():
+            pager = self._col._pager(source)
+            while todo and self._busy[source] < self._prefetch:
+                page = [todo.popleft() for _ in range(min(pager.take(), len(todo)))]
+                future = asyncio.ensure_future(self._col._fetch(source, page))
+                self._inflight[future] = source
+                self._order.append(future)
+                self._busy[source] += 1
+    
+    def __aiter__(self):
+        return self
+    async def __anext__(self):
+        while not self._ready:
+            self._schedule()
+            if not self._order:
+                col = self._col
+                if not col._stubs.missing:
+                    col._complete_cache = col._get_next = col._mock
+                raise StopAsyncIteration
+            done, _ = await asyncio.wait(list(self._inflight), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                self._busy[self._inflight.pop(future)] -= 1
+            self._schedule()
+            # Finished pages free their slot at once but are yielded in request order
+            while self._order and self._order[0].done():
+                self._ready.extend(self._col._add_page(self._order.popleft().result()))
+        return self._wrap(self._ready.popleft())
+    
+    def __iter__(self):
+        return self
+    def __next__(self):
+        if self._ready:
+            return self._wrap(self._ready.popleft())
+        try:
+            return self._col._block(self.__anext__())
+        except StopAsyncIteration:
+            raise StopIteration
 
 class UnisCollection(object):
     class Context(object):
@@ -24,17 +346,45 @@ class UnisCollection(object):
             return self._obj.__getattribute__(n)
         def __getitem__(self, i):
             return oContext(self._obj.__getitem__(i), self._rt)
-        def where(self, pred):
-            for v in self._obj.where(pred):
+        def where(self, pred, prefetch=None):
+            result = self._obj.where(pred)
+            if prefetch:
+                result = list(result)
+                self._rt.prefetch(result, prefetch)
+            for v in result:
                 yield oContext(v, self._rt)
         def __iter__(self):
             for v in self._obj.__iter__():
                 yield oContext(v, self._rt)
+        def stream(self, prefetch=None):
+            return self._obj.stream(prefetch, lambda v: oContext(v, self._rt))
+        def astream(self, prefetch=None):
+            return self._obj.astream(prefetch, lambda v: oContext(v, self._rt))
         def __repr__(self):
             return self._obj.__repr__()
         def __len__(self):
             return self._obj.__len__()
+    class AsyncContext(Context):
+        """ Awaitable view of a collection, runs on the caller's event loop """
+        async def get(self, hrefs):
+            return await self._obj.aget(hrefs)
+        async def where(self, pred, prefetch=None):
+            result = await self._obj.awhere(pred)
+            if prefetch:
+                await self._rt.aprefetch(result, prefetch)
+            return [oContext(v, self._rt) for v in result]
+        async def load(self):
+            return [oContext(v, self._rt) for v in await self._obj.aload()]
+        def stream(self, prefetch=None):
+            return self._obj.astream(prefetch, lambda v: oContext(v, self._rt))
+        def __aiter__(self):
+            return self.stream()
+        def __iter__(self):
+            raise TypeError("Async collections are iterated with `async for`")
+        def __getitem__(self, i):
+            raise TypeError("Async collections are not indexable, use `await col.get(hrefs)` or `await col.where(pred)`")
     collections = {}
+    _COMPACT = 1024
     
     async def _mock(self):
         return None
@@ -42,8 +392,18 @@ class UnisCollection(object):
     @trace.debug("UnisCollection")
     def get_collection(cls, name, model, runtime):
         cls.collections[name] = cls.collections.get(name, cls(name, model))
-        cls.collections[name]._growth = runtime.settings["cache"]["growth"]
         cls.collections[name]._subscribe = runtime.settings["proxy"]["subscribe"]
+        cls.collections[name]._pushdown = runtime.settings["cache"].get("pushdown", True)
+        cls.collections[name]._prefetch = runtime.settings["cache"].get("prefetch", 2)
+        cls.collections[name]._pinned, cls.collections[name]._lock = runtime.pinned, runtime._lock
+        cache, _int = runtime.settings["cache"], lambda x: int(x) if x else None
+        paging = { "mode": cache.get("paging", "exponential"), "size": _int(cache.get("page_size", 10)), "growth": float(cache.get("growth", 2)),
+                   "limit": _int(cache.get("page_limit", 1000)), "latency": float(cache.get("target_latency", 0.5)),
+                   "payload": _int(cache.get("target_bytes", 1048576)) }
+        if paging != cls.collections[name]._paging:
+            cls.collections[name]._paging, cls.collections[name]._pagers = paging, {}
+        if cache.get("eviction", None) and cls.collections[name]._policy is None:
+            cls.collections[name]._policy = _Eviction(cache["eviction"], _int(cache.get("max_entries", None)), _int(cache.get("max_bytes", None)))
         return UnisCollection.Context(cls.collections[name], runtime)
     
     @trace.debug("UnisCollection")
@@ -51,8 +411,10 @@ class UnisCollection(object):
         self._complete_cache, self._get_next = self._proto_complete_cache, self._proto_get_next
         self.name, self.model = name, model
         self._indices, self._services, self._unis = {}, [], UnisProxy(name)
-        self._block_size = 10
-        self._stubs, self._cache = {}, _sparselist()
+        self._prefetch, self._pushdown = 2, True
+        self._paging, self._pagers = {}, {}
+        self._policy, self._pinned, self._lock = None, lambda v: False, threading.RLock()
+        self._stubs, self._cache = _stubmap(), _slotmap()
         self.createIndex("id")
         self.createIndex("selfRef")
         self._loop = asyncio.get_event_loop()
@@ -60,40 +422,56 @@ class UnisCollection(object):
         
     @trace.debug("UnisCollection")
     def __getitem__(self, i):
-        self._loop.run_until_complete(self._complete_cache())
+        self._fill_cache()
+        if self._policy is not None and isinstance(i, int) and self._cache[i] is not None:
+            self._policy.touch(i % self._cache.slots())
         return self._cache[i]
     
     @trace.debug("UnisCollection")
+    @_locked
     def __setitem__(self, i, item):
         self._check_record(item)
         if self._cache[i].selfRef != item.selfRef:
             raise AttributeError("Resource selfRefs do not match")
         
         if getattr(self._cache[i], "ts", 0) < item.ts:
-            for k,v in item.__dict__.items():
-                self._cache[i].__dict__[k] = v
+            self._cache[i]._merge(item)
             for _,index in self._indices.items():
                 index.update(i, self._cache[i])
-            if self._cache[i]._getattribute("selfRef"):
-                self._stubs[self._unis.refToUID(self._cache[i]._getattribute("selfRef"))] = self._cache[i]
+            if self._cache[i].selfRef:
+                self._stubs[self._unis.refToUID(self._cache[i].selfRef)] = self._cache[i]
+            if self._policy is not None:
+                self._policy.touch(i)
             self._serve(Events.update, self._cache[i])
     
     @trace.info("UnisCollection")
     def load(self):
-        self._loop.run_until_complete(self._complete_cache())
-        return list(self._cache)
+        return list(self.stream())
+    @trace.info("UnisCollection")
+    async def aload(self):
+        result = []
+        async for v in self.astream():
+            result.append(v)
+        return result
+    
+    @trace.info("UnisCollection")
+    def stream(self, prefetch=None, wrap=None):
+        return _Stream(self, prefetch or self._prefetch, wrap=wrap)
+    @trace.info("UnisCollection")
+    def astream(self, prefetch=None, wrap=None):
+        return _Stream(self, prefetch or self._prefetch, wrap=wrap)
     
     @trace.info("UnisCollection")
     def get(self, hrefs):
-        hrefs = list(map(self._unis.refToUID, (hrefs if isinstance(hrefs, list) else [hrefs])))
-        if any(x not in self._stubs for x in hrefs):
-                raise UnisReferenceError("Requested object in unknown location", hrefs)
-        to_get = [v for v in hrefs if not self._stubs[v]]
-        if to_get:
-            self._loop.run_until_complete(self._get_next(to_get))
-        return [self._stubs[href] for href in hrefs]
+        hrefs, to_get = self._lookup(hrefs)
+        return self._found(hrefs, self._block(self._load(to_get)) if to_get else {})
+    @trace.info("UnisCollection")
+    async def aget(self, hrefs):
+        hrefs, to_get = self._lookup(hrefs)
+        return self._found(hrefs, (await self._load(to_get)) if to_get else {})
     
     @trace.info("UnisCollection")
+    @_locked
     def append(self, item):
         self._check_record(item)
         item.setCollection(self)
@@ -102,15 +480,47 @@ class UnisCollection(object):
             self.__setitem__(i, item)
             return self._cache[i]
         else:
-            i = len(self._cache)
-            self._cache.append(item)
+            i = self._cache.add(item)
             for _,index in self._indices.items():
                 index.update(i, oContext(item, None))
             if item.selfRef:
                 self._stubs[self._unis.refToUID(item.selfRef)] = item
+            if self._policy is not None:
+                self._policy.add(i, item)
+                self._evict()
             self._serve(Events.new, item)
             return item
     
+    @trace.info("UnisCollection")
+    @_locked
+    def extend(self, items):
+        items, result, new = list(items), [], []
+        list(map(self._check_record, items))
+        for item in items:
+            ref = item.selfRef
+            # Without a selfRef a record can only match itself
+            i = self.index(item) if ref or item._rt_collection is self else None
+            item.setCollection(self)
+            if not isinstance(i, type(None)):
+                self.__setitem__(i, item)
+                result.append(self._cache[i])
+            else:
+                i = self._cache.add(item)
+                self._indices['id'].update(i, oContext(item, None))
+                new.append((i, item, ref))
+                result.append(item)
+        for key, index in self._indices.items():
+            if key != 'id':
+                index.update_many((i, oContext(item, None)) for i, item, _ in new)
+        self._stubs.update({ self._unis.refToUID(ref): item for _, item, ref in new if ref })
+        if self._policy is not None:
+            for i, item, _ in new:
+                self._policy.add(i, item)
+            self._evict()
+        for _, item, _ in new:
+            self._serve(Events.new, item)
+        return result
+    
     @trace.info("UnisCollection")
     def remove(self, item):
         self._check_record(item)
@@ -129,42 +539,45 @@ class UnisCollection(object):
     
     @trace.info("UnisCollection")
     def where(self, pred):
-        op = {
-            "gt": lambda b: lambda a: type(a) is type(b) and a > b, 
-            "ge": lambda b: lambda a: type(a) is type(b) and a >= b,
-            "lt": lambda b: lambda a: type(a) is type(b) and a < b,
-            "le": lambda b: lambda a: type(a) is type(b) and a <= b,
-            "eq": lambda b: lambda a: type(a) is type(b) and a == b
-        }
-        self._loop.run_until_complete(self._complete_cache())
         if isinstance(pred, types.FunctionType):
-            for v in filter(pred, self._cache):
+            for v in filter(pred, self.stream()):
+                yield v
+            return
+        query = _Query(pred)
+        complete = self._complete_cache == self._mock
+        if not complete and not (self._pushdown and self._block(self._get_matching(query))):
+            for v in filter(query, self.stream()):
                 yield v
         else:
-            non_index = {}
-            subset = set(range(len(self._cache)))
-            for k,v in pred.items():
-                v = v if isinstance(v, dict) else { "eq": v }
-                if k in self._indices:
-                    for f,v in v.items():
-                        subset &= self._indices[k].subset(f, v)
-                else:
-                    for f,v in v.items():
-                        non_index[k] = op[f](v)
-            
-            for i in subset:
-                record = self._cache[i]
-                if all([v(record._getattribute(k, None, None)) for k,v in non_index.items()]):
-                    yield record
+            yield from self._select(query)
+    @trace.info("UnisCollection")
+    async def awhere(self, pred):
+        query, result = pred if isinstance(pred, types.FunctionType) else _Query(pred), []
+        if query is pred or not (self._complete_cache == self._mock or (self._pushdown and await self._get_matching(query))):
+            async for v in self.astream():
+                if query(v):
+                    result.append(v)
+            return result
+        return list(self._select(query))
+    
+    @trace.info("UnisCollection")
+    def explain(self, pred):
+        query, total = _Query(pred), self._cache.slots()
+        key, rel, v, estimate = query.plan(self._indices, total)
+        return { "scan": "full" if key is None else "index", "index": key, "op": rel, "value": v,
+                 "estimate": estimate, "total": total, "checks": len(query) }
     
     @trace.info("UnisCollection")
+    @_locked
     def createIndex(self, k):
+        k = tuple(k) if isinstance(k, list) else k
         index = Index(k)
         self._indices[k] = index
-        for i, v in enumerate(self._cache):
-            index.update(i, oContext(v))
+        for i, v in self._cache.items():
+            index.update(i, v)
     
     @trace.info("UnisCollection")
+    @_locked
     def updateIndex(self, v):
         i = self.index(v)
         for key, index in self._indices.items():
@@ -186,11 +599,78 @@ class UnisCollection(object):
     def addCallback(self, cb):
         self._callbacks.append(cb)
     
+    @trace.info("UnisCollection")
+    def stats(self):
+        return { source: pager.stats() for source, pager in self._pagers.items() }
+    
+    @trace.info("UnisCollection")
+    @_locked
+    def compact(self):
+        mapping = self._cache.compact()
+        for index in self._indices.values():
+            index.remap(mapping)
+        if self._policy is not None:
+            self._policy.remap(mapping)
+    
+    @trace.debug("UnisCollection")
+    def _discard(self, i):
+        v = self._cache[i]
+        self._cache.discard(i)
+        for index in self._indices.values():
+            index.remove(i)
+        if self._policy is not None:
+            self._policy.discard(i)
+        if self._cache.holes() > max(self._COMPACT, len(self._cache)):
+            self.compact()
+        return v
+    
+    @trace.debug("UnisCollection")
+    def _evict(self):
+        policy = self._policy
+        if not policy.over():
+            return
+        evict, count, total = [], len(policy), policy.total
+        for i in policy.victims():
+            if not policy.over(count, total):
+                break
+            v = self._cache[i]
+            if self._pinned(v) or not oContext(v, None).selfRef:
+                continue
+            evict.append(i)
+            count, total = count - 1, total - policy._bytes.get(i, 0)
+        for i in evict:
+            self._stubs[self._unis.refToUID(oContext(self._discard(i), None).selfRef)] = None
+        if evict:
+            self._complete_cache, self._get_next = self._proto_complete_cache, self._proto_get_next
+    
     @trace.debug("UnisCollection")
     def _check_record(self, v):
         if self.model._rt_schema["name"] not in v.names:
             raise TypeError("Resource not of correct type: got {}, expected {}".format(self.model, type(v)))
         
+    def _lookup(self, hrefs):
+        hrefs = list(map(self._unis.refToUID, (hrefs if isinstance(hrefs, list) else [hrefs])))
+        if any(x not in self._stubs for x in hrefs):
+            raise UnisReferenceError("Requested object in unknown location", hrefs)
+        return hrefs, [v for v in hrefs if not self._stubs[v]]
+    async def _load(self, to_get):
+        loaded = {}
+        if self._policy is not None:
+            # Fetch only what was asked for so the page cannot evict the records it returns
+            for v in self._add_page(await self._get_page(to_get)):
+                loaded[self._unis.refToUID(oContext(v, None).selfRef)] = v
+        else:
+            await self._get_next(to_get)
+        return loaded
+    def _found(self, hrefs, loaded):
+        result = [self._stubs[href] or loaded.get(href, None) for href in hrefs]
+        if self._policy is not None:
+            for v in result:
+                i = self._indices['selfRef'].index(oContext(v, None).selfRef) if v is not None else None
+                if i is not None:
+                    self._policy.touch(i)
+        return result
+    
     @trace.debug("UnisCollection")
     def _serve(self, ty, v):
         ctx = oContext(v, None)
@@ -200,72 +680,144 @@ class UnisCollection(object):
             f = getattr(service, ty.name)
             f(ctx)
     
+    @_locked
+    def _select(self, query):
+        key, rel, v, _ = query.plan(self._indices, self._cache.slots())
+        slots = range(self._cache.slots()) if key is None else sorted(self._indices[key].subset(rel, v))
+        matches = []
+        for i in slots:
+            record = self._cache[i]
+            if record is not None and query(record):
+                if self._policy is not None:
+                    self._policy.touch(i)
+                matches.append(record)
+        return matches
+    
+    @trace.debug("UnisCollection")
+    async def _get_matching(self, query):
+        params = query.params()
+        if not params:
+            return False
+        try:
+            results = await self._unis.get(filters=params)
+        except UnisError as exp:
+            logging.getLogger().warning("Filter pushdown on {} failed, filtering locally - {}".format(self.name, exp))
+            return False
+        self._add_page(results)
+        return True
+    
+    @trace.debug("UnisCollection")
+    def _fill_cache(self):
+        if self._complete_cache != self._mock:
+            self._block(self._complete_cache())
+    
+    def _block(self, coro):
+        # A thread already running a loop cannot wait on another, point coroutines at the awaitables
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self._loop.run_until_complete(coro)
+        coro.close()
+        raise RuntimeError("Collection '{}' must fetch from UNIS and cannot block inside a running event loop, "
+                           "use the AsyncRuntime awaitables instead (find, prefetch, get, where, load, async for)".format(self.name))
+    
     @trace.debug("UnisCollection")
     async def _proto_complete_cache(self):
-        self._block_size = max(self._block_size, len(self._stubs) - len(self._cache))
-        await self._get_next()
+        async for _ in _Stream(self, self._prefetch, cached=False):
+            pass
         
     @trace.debug("UnisCollection")
     async def _proto_get_next(self, ids=None):
         ids = ids or []
-        todo = (k for k in self._stubs.keys() if not self._stubs[k])
-        while len(ids) < self._block_size:
-            try:
-                ids.append(next(todo))
-            except StopIteration:
-                self._complete_cache = self._get_next = self._mock
-                break
+        requested, pages, sizes = set(ids), defaultdict(list), {}
+        for k in ids:
+            pages[k[0]].append(k)
+        for k,v in self._stubs.items():
+            if not v and k not in requested:
+                if k[0] not in sizes:
+                    sizes[k[0]] = self._pager(k[0]).take()
+                if len(pages[k[0]]) < sizes[k[0]]:
+                    pages[k[0]].append(k)
+        ids = list(itertools.chain(*pages.values()))
+        if len(set(ids)) >= self._stubs.missing:
+            self._complete_cache = self._get_next = self._mock
+        self._add_page(await self._get_page(ids))
+    
+    @trace.debug("UnisCollection")
+    async def _get_page(self, ids):
         requests = defaultdict(list)
         for v in ids:
             requests[v[0]].append(v[1][1])
-        results = await asyncio.gather(*[self._get_block(k, v, self._block_size) for k,v in requests.items()])
-        self._block_size *= self._growth
-        for result in itertools.chain(*results):
+        results = await asyncio.gather(*[self._fetch(k, v) for k,v in requests.items()])
+        return list(itertools.chain(*results))
+    
+    @trace.debug("UnisCollection")
+    async def _fetch(self, source, ids):
+        loop = asyncio.get_event_loop()
+        pager, start = self._pager(source), loop.time()
+        results = await self._get_block(source, ids, pager.limit)
+        if isinstance(results, _Payload):
+            nbytes = results.nbytes
+        else:
+            # The source did not report its payload, measure the page in the configured codec
+            nbytes = len(codec.dumps(results)) if results else 0
+        pager.observe(len(results), loop.time() - start, nbytes)
+        return results
+    
+    @trace.debug("UnisCollection")
+    def _pager(self, source):
+        if source not in self._pagers:
+            self._pagers[source] = _Pager(**self._paging)
+        return self._pagers[source]
+    
+    @trace.debug("UnisCollection")
+    def _add_page(self, results):
+        records = []
+        for result in results:
             model = schemaLoader.get_class(result["$schema"], raw=True)
-            self.append(model(result))
+            records.append(self.append(model(result, lazy=True)))
+        return records
     
     @trace.debug("UnisCollection")
     async def _get_block(self, source, ids, blocksize):
-        source = (source, (self.name, '0'))
         if len(ids) > blocksize:
             requests = [ids[i:i + blocksize] for i in range(0, len(ids), blocksize)]
             futures = [self._get_block(source, req, blocksize) for req in requests]
             results = await asyncio.gather(*futures)
-            return list(itertools.chain(*results))
+            return _Payload.join(results)
         else:
-            return await self._from_unis(source, kwargs={"id": ids})
+            return await self._from_unis((source, (self.name, '0')), kwargs={"id": ids})
     
     @trace.debug("UnisCollection")
     async def _add_subscription(self, sources):
         @trace.debug("UnisCollection._add_subscription")
         def cb(v, action):
-            if action in ['POST', 'PUT']:
-                try:
-                    schema = v.get("\\$schema", None) or v['$schema']
-                except KeyError:
-                    raise ValueError("No schema in message from UNIS - {}".format(v))
-                model = schemaLoader.get_class(schema, raw=True)
-                if action == 'POST':
-                    resource = model(v)
-                    self.append(resource)
-                else:
+            with self._lock:
+                if action in ['POST', 'PUT']:
                     try:
-                        index = self.indices['id'].index(v['id'])
-                    except IndexError:
-                        return
-                    old = self._cache[index].to_JSON()
-                    self[index] = model({**old, **v})
-            elif action == 'DELETE':
-                try:
+                        schema = v.get("\\$schema", None) or v['$schema']
+                    except KeyError:
+                        raise ValueError("No schema in message from UNIS - {}".format(v))
+                    model = schemaLoader.get_class(schema, raw=True)
+                    if action == 'POST':
+                        resource = model(v, lazy=True)
+                        self.append(resource)
+                    else:
+                        index = self._indices['id'].index(v['id'])
+                        if index is None:
+                            return
+                        old = self._cache[index].to_JSON()
+                        self[index] = model({**old, **v}, lazy=True)
+                elif action == 'DELETE':
                     i = self._indices['id'].index(v['id'])
-                    v = self._cache[i]
+                    if i is None:
+                        # Evicted or never loaded, only the stub is left to forget
+                        self._stubs.pop(self._unis.refToUID(v['selfRef']), None)
+                        return
+                    v = self._discard(i)
                     v.delete()
-                    self._cache[i] = None
-                    del self._stubs[self._unis.refToUID(v.selfRef)]
+                    del self._stubs[self._unis.refToUID(oContext(v, None).selfRef)]
                     self._serve(Events.delete, v)
-                    
-                except IndexError:
-                    raise ValueError("No such element in UNIS to delete")
         if self._subscribe:
             self._subscribe = False
             await self._unis.subscribe(sources, cb)
@@ -282,7 +834,7 @@ class UnisCollection(object):
     
     @trace.debug("UnisCollection")
     def __len__(self):
-        return len(self._cache) + len([x for x,v in self._stubs.items() if not v])
+        return len(self._cache) + self._stubs.missing
     
     @trace.debug("UnisCollection")
     def __contains__(self, item):
@@ -290,5 +842,4 @@ class UnisCollection(object):
     
     @trace.debug("UnisCollection")
     def __iter__(self):
-        self._loop.run_until_complete(self._complete_cache())
-        return iter(self._cache)
+        return self.stream()
@@ -1,8 +1,10 @@
 import asyncio
+import functools
 import itertools
 import json
 import jsonschema
 import os
+import pickle
 import re
 import requests
 import time
@@ -10,29 +12,39 @@ import time
 from lace.logging import trace
 from urllib.parse import urlparse
 
-from unis.settings import SCHEMA_CACHE_DIR
+from unis.codec import codec
+from unis.settings import SCHEMA_CACHE_DIR, SCHEMA_CACHE_FILE, SCHEMA_TIMEOUT
 
-class _attr(object):
-    def __init__(self, default=None):
-        self._default, self.__values__ = default, {}
-    def __get__(self, obj, cls):
-        return self.__values__.get(obj, self._default)
-    def __set__(self, obj, v):
-        self.__values__[obj] = v
-    
 class Context(object):
-    _obj, _rt = _attr(), _attr()
-    def __init__(self, obj, runtime):
-        self._obj, self._rt = obj, runtime
-    def __getattribute__(self, n):
-        if not hasattr(type(self), n):
-            v = self._obj._getattribute(n, self._rt)
+    __slots__ = ('_obj', '_rt', '_bound', '__weakref__')
+    def __new__(cls, obj, runtime):
+        cache = obj._rt_ctx
+        if cache is None:
+            cache = obj._rt_ctx = {}
+        try:
+            return cache[runtime]
+        except KeyError:
+            ctx = cache[runtime] = super(Context, cls).__new__(cls)
+            ctx._obj, ctx._rt, ctx._bound = obj, runtime, None
+            return ctx
+    def __getattr__(self, n):
+        obj, rt = self._obj, self._rt
+        v = object.__getattribute__(obj, '__dict__').get(n)
+        if not isinstance(v, _unistype):
+            if self._bound and n in self._bound:
+                return self._bound[n]
+            v = obj._getattribute(n, rt)
             if callable(v):
-                return lambda *args, **kwargs: v(*args, ctx=self._rt, **kwargs)
-            return Context(v, self._rt) if isinstance(v, _unistype) else v
-        return super(Context, self).__getattribute__(n)
+                if getattr(v, '__self__', None) is not obj:
+                    return lambda *args, **kwargs: v(*args, ctx=rt, **kwargs)
+                self._bound = self._bound or {}
+                self._bound[n] = functools.partial(v, ctx=rt)
+                return self._bound[n]
+        else:
+            v = object.__getattribute__(v, '_rt_raw')
+        return Context(v, rt) if isinstance(v, _unistype) else v
     def __setattr__(self, n, v):
-        if hasattr(type(self), n):
+        if n in _contextattrs:
             return super(Context, self).__setattr__(n, v)
         return self._obj._setattr(n, v, self._rt)
     def __getitem__(self, i):
@@ -41,8 +53,9 @@ class Context(object):
     def __setitem__(self, i, v):
         return self._obj._setitem(i, v, self._rt)
     def __iter__(self):
-        for v in self._obj._iter(self._rt):
-            yield Context(v, self._rt) if isinstance(v, _unistype) else v
+        rt = self._rt
+        for v in self._obj._iter(rt):
+            yield Context(v, rt) if isinstance(v, _unistype) else v
     def __dir__(self):
         return self._obj.__dir__()
     def __repr__(self):
@@ -51,17 +64,22 @@ class Context(object):
     def getRuntime(self):
         return self._rt
     def setRuntime(self, runtime):
-        self._rt = runtime
+        cache = self._obj._rt_ctx
+        if cache.get(self._rt) is self:
+            del cache[self._rt]
+        self._rt, self._bound = runtime, None
+        cache.setdefault(runtime, self)
     def getObject(self):
         return self._obj
+_contextattrs = frozenset(dir(Context))
 
 class _nodefault(object): pass
 class _unistype(object):
-    _rt_parent = _attr()
-    _rt_source, _rt_raw, _rt_reference = _attr(), _attr(), _attr()
+    __slots__ = ('_rt_parent', '_rt_source', '_rt_raw', '_rt_reference', '_rt_ctx', '_rt_lazy', '__dict__', '__weakref__')
     _rt_restricted = []
     @trace.debug("unistype")
-    def __init__(self, v, ref):
+    def __init__(self, v, ref, lazy=False):
+        self._rt_parent, self._rt_source, self._rt_ctx, self._rt_lazy = None, None, None, lazy
         self._rt_reference, self._rt_raw, = ref, self
     
     def __getattribute__(self, n):
@@ -69,19 +87,21 @@ class _unistype(object):
             if n in self._rt_restricted:
                 return self._getattribute(n, None)
             raise NotImplementedError # This is for debugging purposes, this line should never be reached
-        return super(_unistype, self).__getattribute__(n)
+        return object.__getattribute__(self, n)
     @trace.debug("unistype")
     def _getattribute(self, n, ctx, default=_nodefault()):
+        d = self.__dict__
+        if n in d:
+            v = d[n]
+            if not isinstance(v, _unistype):
+                v = d[n] = self._lift(v, self._get_reference(n), ctx, self._rt_lazy)
+            return v._rt_raw
         try:
-            v = super(_unistype, self).__getattribute__(n)
+            return super(_unistype, self).__getattribute__(n)
         except AttributeError:
-            v = default
             if isinstance(default, _nodefault):
                 raise
-        if n != '__dict__' and n in self.__dict__:
-            self.__dict__[n] = self._lift(v, self._get_reference(n), ctx)
-            return self.__dict__[n]._rt_raw
-        return v
+            return default
     
     @trace.debug("unistype")
     def __setattr__(self, n, v):
@@ -98,21 +118,21 @@ class _unistype(object):
             eq = lambda a,b: (isinstance(a, _unistype) and a._rt_raw == b._rt_raw) or a == b._rt_raw
             newvalue = self._lift(v, self._get_reference(n), ctx)
             if n not in self.__dict__ or not eq(self.__dict__[n], newvalue):
-                super(_unistype, self).__setattr__(n, self._lift(v, self._get_reference(n), ctx))
+                super(_unistype, self).__setattr__(n, newvalue)
                 self._update(self._get_reference(n), ctx)
     
     @trace.debug("unistype")
-    def _lift(self, v, ref, ctx):
+    def _lift(self, v, ref, ctx, lazy=False):
         v = v.getObject() if isinstance(v, Context) else v
         if isinstance(v, _unistype):
             return v
         elif isinstance(v, dict):
             if '$schema' in v or 'href' in v:
                 v = ctx.insert(v) if "$schema" in v else ctx.find(v['href'])[0]
-            else:
-                v =  Local(v, ref)
+                return v.getObject() if isinstance(v, Context) else v
+            v =  Local(v, ref, lazy)
         elif isinstance(v, list):
-            v = List(v, ref)
+            v = List(v, ref, lazy)
         else:
             v = Primitive(v, ref)
         v._rt_parent = self._rt_parent
@@ -123,6 +143,9 @@ class _unistype(object):
         if self._rt_parent:
             self._rt_parent._update(ref, ctx)
     @trace.debug("unistype")
+    def _adopt(self, parent):
+        self._rt_parent = parent
+    @trace.debug("unistype")
     def _get_reference(self, n):
         raise NotImplemented()
     @trace.info("unistype")
@@ -145,26 +168,32 @@ class Primitive(_unistype):
         return "<unis.Primitive {}>".format(self._rt_raw)
     
 class List(_unistype):
-    _rt_ls = _attr()
+    __slots__ = ('_rt_ls',)
     @trace.debug("List")
-    def __init__(self, v, ref):
-        super(List, self).__init__(v, ref)
+    def __init__(self, v, ref, lazy=False):
+        super(List, self).__init__(v, ref, lazy)
         v = v if isinstance(v, list) else [v]
         self._rt_ls = [x for x in v]
     @trace.debug("List")
     def _getitem(self, i, ctx):
-        return self._lift(self._rt_ls[i], self._rt_reference, ctx)._rt_raw
+        v = self._rt_ls[i]
+        if isinstance(i, slice):
+            return self._lift(v, self._rt_reference, ctx, self._rt_lazy)._rt_raw
+        if not isinstance(v, _unistype):
+            v = self._rt_ls[i] = self._lift(v, self._rt_reference, ctx, self._rt_lazy)
+        return v._rt_raw
     @trace.debug("list")
     def _setitem(self, i, v, ctx):
         self._rt_ls[i] = self._lift(v, self._rt_reference, ctx)
-        self._update(self._rt_reference)
+        self._update(self._rt_reference, ctx)
     @trace.info("List")
     def append(self, v, ctx):
         self._rt_ls.append(self._lift(v, self._rt_reference, ctx))
         self._update(self._rt_reference, ctx)
     @trace.info("List")
     def remove(self, v, ctx):
-        return self._rt_ls.remove(v)
+        self._rt_ls.remove(v)
+        self._update(self._rt_reference, ctx)
     @trace.info("List")
     def where(self, f, ctx):
         if isinstance(pred, types.FunctionType):
@@ -183,16 +212,33 @@ class List(_unistype):
             return (x for x in self if all(map(lambda v: _check(x,*v), f)))
     
     @trace.debug("List")
+    def _adopt(self, parent):
+        super(List, self)._adopt(parent)
+        for v in self._rt_ls:
+            if isinstance(v, _unistype) and not isinstance(v, UnisObject):
+                v._adopt(parent)
+    @trace.debug("List")
     def _get_reference(self, n):
         return self._rt_reference
     @trace.info("List")
     def to_JSON(self, ctx, top):
-        self._rt_ls = [self._lift(x, self._rt_reference, ctx) for x in self._rt_ls]
-        return list(map(lambda x: x.to_JSON(ctx, top), [x for x in self._rt_ls if x._getattribute('selfRef', ctx, True)]))
+        result, ls, lazy = [], self._rt_ls, self._rt_lazy
+        for i, x in enumerate(ls):
+            if not isinstance(x, _unistype):
+                if lazy:
+                    result.append(x)
+                    continue
+                x = ls[i] = self._lift(x, self._rt_reference, ctx)
+            if not isinstance(x, UnisObject) or x.selfRef:
+                result.append(x.to_JSON(ctx, top))
+        return result
     @trace.debug("List")
     def _iter(self, ctx):
-        self._rt_ls = list(map(lambda x: self._lift(x, self._rt_reference, ctx), self._rt_ls))
-        return map(lambda x: x._rt_raw, self._rt_ls)
+        ls, lazy = self._rt_ls, self._rt_lazy
+        for i, x in enumerate(ls):
+            if not isinstance(x, _unistype):
+                x = ls[i] = self._lift(x, self._rt_reference, ctx, lazy)
+            yield x._rt_raw
     @trace.debug("List")
     def __len__(self):
         return len(self._rt_ls)
@@ -205,32 +251,47 @@ class List(_unistype):
 
 class Local(_unistype):
     @trace.debug("Local")
-    def __init__(self, v, ref):
-        super(Local, self).__init__(v, ref)
-        for k,v in v:
-            self.__dict__[k] = v
+    def __init__(self, v, ref, lazy=False):
+        super(Local, self).__init__(v, ref, lazy)
+        self.__dict__.update(v)
+    @trace.debug("Local")
+    def _adopt(self, parent):
+        super(Local, self)._adopt(parent)
+        for v in self.__dict__.values():
+            if isinstance(v, _unistype) and not isinstance(v, UnisObject):
+                v._adopt(parent)
     @trace.debug("Local")
     def _get_reference(self, n):
         return self._rt_reference
     @trace.info("Local")
     def to_JSON(self, ctx, top):
-        return {k:self._lift(v, self._rt_reference, ctx).to_JSON(ctx, top) for k,v in self.__dict__.items()}
+        result, lazy = {}, self._rt_lazy
+        for k,v in self.__dict__.items():
+            if isinstance(v, _unistype):
+                result[k] = v.to_JSON(ctx, top)
+            else:
+                result[k] = v if lazy else self._lift(v, self._rt_reference, ctx).to_JSON(ctx, top)
+        return result
     @trace.none
     def __repr__(self):
         return "<unis.Local {}>".format(self.__dict__.__repr__())
 
 class _metacontextcheck(type):
     def __instancecheck__(self, other):
-        other = other.getObject() if hasattr(other, 'getObject') else other
+        other = other.getObject() if isinstance(other, Context) else other
         return super(_metacontextcheck, self).__instancecheck__(other)
 class UnisObject(_unistype, metaclass=_metacontextcheck):
-    _rt_remote, _rt_collection = _attr(), _attr()
+    __slots__ = ('_rt_remote', '_rt_collection', '_rt_dirty', '_rt_frag', '_rt_stored')
     _rt_restricted, _rt_live = ["ts", "selfRef"], False
     _rt_callback = lambda s,x,e: x
+    _rt_generation, _rt_validator = 0, None
     @trace.debug("UnisObject")
-    def __init__(self, v=None, ref=None):
+    def __init__(self, v=None, ref=None, lazy=False):
         v = v or {}
-        super(UnisObject, self).__init__(v, ref)
+        super(UnisObject, self).__init__(v, ref, lazy)
+        self._rt_collection, self._rt_dirty, self._rt_frag = None, None, None
+        # Documents arriving with a selfRef are already held by a server
+        self._rt_stored = 'selfRef' in v
         self._rt_parent, self._rt_remote, self._rt_live = self, set(v.keys()) | set(self._rt_defaults.keys()), True
         self.__dict__.update({**self._rt_defaults, **v, **{'$schema': self._rt_schema['id']}})
         
@@ -241,9 +302,35 @@ class UnisObject(_unistype, metaclass=_metacontextcheck):
         super(UnisObject, self)._setattr(n, v, ctx)
     @trace.debug("UnisObject")
     def _update(self, ref, ctx):
-        if ref in self._rt_remote and ctx and self._rt_live:
-            self.__dict__['ts'] = int(time.time() * 1000000)
-            ctx.update(Context(self, ctx))
+        if ref in self._rt_remote:
+            self._invalidate(ref)
+            if ctx and self._rt_live:
+                self.__dict__['ts'] = int(time.time() * 1000000)
+                ctx.update(Context(self, ctx))
+    @trace.debug("UnisObject")
+    def _invalidate(self, ref=None):
+        if ref is None:
+            self._rt_frag = None
+            return
+        if self._rt_dirty is None:
+            self._rt_dirty = set()
+        self._rt_dirty.add(ref)
+        if self._rt_frag:
+            self._rt_frag.pop(ref, None)
+    @trace.debug("UnisObject")
+    def _merge(self, other):
+        for k,v in other.__dict__.items():
+            if isinstance(v, _unistype) and not isinstance(v, UnisObject):
+                v._adopt(self)
+            self.__dict__[k] = v
+        self._rt_lazy = self._rt_lazy and other._rt_lazy
+        self._rt_stored = self._rt_stored or other._rt_stored
+        self._invalidate()
+    @trace.debug("UnisObject")
+    def _set_selfref(self, ref):
+        if self._getattribute('selfRef', None) != ref:
+            self.__dict__['selfRef'] = ref
+            UnisObject._rt_generation += 1
     @trace.debug("UnisObject")
     def _get_reference(self, n):
         return n
@@ -251,8 +338,9 @@ class UnisObject(_unistype, metaclass=_metacontextcheck):
     def touch(self, ctx):
         if self._getattribute('selfRef', ctx):
             self.__dict__['ts'] = int(time.time() * 1000000)
-            payload = json.dumps({'ts': self.ts})
-            asyncio.get_event_loop().run_until_complete(self._rt_collection._unis.put(self._getattribute('selfRef', ctx), payload))
+            payload = codec.dumps({'ts': self.ts})
+            put = self._rt_collection._unis.put(self._getattribute('selfRef', ctx), payload)
+            ctx._run(put) if ctx else asyncio.get_event_loop().run_until_complete(put)
     @trace.info("UnisObject")
     def getSource(self, ctx=None):
         url = urlparse(self._getattribute('selfRef', ctx))
@@ -274,24 +362,32 @@ class UnisObject(_unistype, metaclass=_metacontextcheck):
             url = publish_to or ctx.settings['default_source']
             self._rt_source = url
             self.__dict__['ts'] = int(time.time() * 1000000)
-            self.__dict__['selfRef'] = "{}/{}/{}".format(url, self._rt_collection.name, self._getattribute('id', ctx))
+            self._set_selfref("{}/{}/{}".format(url, self._rt_collection.name, self._getattribute('id', ctx)))
             self._update('id', ctx)
     @trace.info("UnisObject")
     def extendSchema(self, n, v=None, ctx=None):
         if v:
             self.__dict__[n] = self._lift(v, n, ctx)
+            if self._rt_frag:
+                self._rt_frag.pop(n, None)
         if n not in self._rt_remote:
             self._rt_remote.add(n)
             self._update(n, ctx)
     @trace.info("UnisObject")
     def addCallback(self, fn, ctx=None):
-        self._rt_callback = lambda s,x,e: fn(Context(x, ctx), e)
+        self._rt_callback = lambda x,e: fn(Context(x, ctx), e)
     @trace.debug("UnisObject")
     def _callback(self, event, ctx=None):
         self._rt_callback(self, event)
     @trace.info("UnisObject")
     def validate(self, ctx):
-        jsonschema.validate(self.to_JSON(ctx), self._rt_schema, resolver=self._rt_resolver)
+        type(self)._get_validator().validate(self.to_JSON(ctx))
+    @classmethod
+    def _get_validator(cls):
+        if cls._rt_validator is None:
+            validator = jsonschema.validators.validator_for(cls._rt_schema, jsonschema.Draft4Validator)
+            cls._rt_validator = validator(cls._rt_schema, resolver=cls._rt_resolver)
+        return cls._rt_validator
     @trace.info("UnisObject")
     def to_JSON(self, ctx=None, top=True):
         result = {}
@@ -301,23 +397,88 @@ class UnisObject(_unistype, metaclass=_metacontextcheck):
         else:
             result = { "rel": "full", "href": self.selfRef }
         return result
+    @trace.info("UnisObject")
+    def serialize(self, ctx=None, fields=None):
+        keys = self._rt_remote if fields is None else self._rt_remote & (set(fields) | set(['id', 'ts']))
+        if self._rt_frag is None:
+            self._rt_frag = {}
+        frags, gen, result = self._rt_frag, UnisObject._rt_generation, []
+        for k,v in self.__dict__.items():
+            if k not in keys:
+                continue
+            if isinstance(v, (dict, list, Local, List)):
+                if k not in frags or frags[k][0] != gen:
+                    frags[k] = (gen, codec.dumps(v.to_JSON(ctx, False) if isinstance(v, _unistype) else v))
+                frag = frags[k][1]
+            else:
+                frag = codec.dumps(v.to_JSON(ctx, False) if isinstance(v, _unistype) else v)
+            result.append("{}: {}".format(codec.dumps(k), frag))
+        return "{{{}}}".format(", ".join(result))
     @trace.none
     def __repr__(self):
         return "<{}.{} {}>".format(self.__class__.__module__, self.__class__.__name__, self.__dict__.__repr__())
     
 
-_CACHE = {}
-if SCHEMA_CACHE_DIR:
+def validate_many(resources, ctx=None, strict=True):
+    # Non-strict validation returns each failing resource with its error instead of raising the first
+    invalid = {}
+    for r in resources:
+        r = r.getObject() if isinstance(r, Context) else r
+        try:
+            type(r)._get_validator().validate(r.to_JSON(ctx))
+        except Exception as exp:
+            if strict:
+                raise
+            invalid[r] = exp
+    return invalid
+
+_CACHE, _ETAGS = {}, {}
+_CACHE_VERSION = 1
+def _load_cache():
     try:
-        os.makedirs(SCHEMA_CACHE_DIR)
-    except FileExistsError:
+        with open(SCHEMA_CACHE_FILE, 'rb') as f:
+            bundle = pickle.load(f)
+        if bundle.get('version') == _CACHE_VERSION:
+            _CACHE.update(bundle['schemas'])
+            _ETAGS.update(bundle['etags'])
+            return
+    except (OSError, EOFError, AttributeError, KeyError, pickle.UnpicklingError):
         pass
-    except OSError as exp:
-        raise exp
-    for n in os.listdir(SCHEMA_CACHE_DIR):
-        with open(SCHEMA_CACHE_DIR + "/" + n) as f:
-            schema = json.load(f)
-            _CACHE[schema['id']] = schema
+    
+    # Migrate caches written as one json file per schema
+    try:
+        names = os.listdir(SCHEMA_CACHE_DIR)
+    except OSError:
+        return
+    for n in filter(lambda n: not n.startswith(os.path.basename(SCHEMA_CACHE_FILE)), names):
+        try:
+            with open(os.path.join(SCHEMA_CACHE_DIR, n)) as f:
+                schema = json.load(f)
+                _CACHE[schema['id']] = schema
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    if _CACHE:
+        _save_cache()
+
+def _save_cache():
+    if SCHEMA_CACHE_DIR:
+        os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+        tmp = "{}.{}".format(SCHEMA_CACHE_FILE, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': _CACHE_VERSION, 'schemas': _CACHE, 'etags': _ETAGS}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, SCHEMA_CACHE_FILE)
+
+def _fetch_schema(uri):
+    resp = requests.get(uri, timeout=SCHEMA_TIMEOUT)
+    schema = resp.json()
+    _CACHE[schema['id']] = schema
+    if resp.headers.get('ETag', None):
+        _ETAGS[schema['id']] = resp.headers['ETag']
+    _save_cache()
+    return schema
+
+if SCHEMA_CACHE_DIR:
+    _load_cache()
 
 def _schemaFactory(schema, n, tys, raw=False):
     class _jsonMeta(*tys):
@@ -331,6 +492,7 @@ def _schemaFactory(schema, n, tys, raw=False):
             cls.names.add(n)
             cls._rt_defaults.update({k:v for k,v in _props(schema).items()})
             cls._rt_schema, cls._rt_resolver = schema, jsonschema.RefResolver(schema['id'], schema, _CACHE)
+            cls._rt_validator = None
             cls.__doc__ = schema.get('description', None)
         
         def __call__(cls, *args, **kwargs):
@@ -346,10 +508,7 @@ class _SchemaCache(object):
     def get_class(self, schema_uri, class_name=None, raw=False):
         key = (schema_uri, raw)
         def _make_class():
-            schema = _CACHE.get(schema_uri, None) or requests.get(schema_uri).json()
-            if SCHEMA_CACHE_DIR and schema_uri not in _CACHE:
-                with open(SCHEMA_CACHE_DIR + "/" + schema['id'].replace('/', ''), 'w') as f:
-                    json.dump(schema, f)
+            schema = _CACHE.get(schema_uri, None) or _fetch_schema(schema_uri)
             parents = [self.get_class(p['$ref'], None, True) for p in schema.get('allOf', [])] or [UnisObject]
             pmeta = [type(p) for p in parents]
             meta = _schemaFactory(schema, class_name or schema['name'], pmeta, raw)
@@ -1,12 +1,16 @@
 import asyncio
 import aiohttp, requests, websockets
-import bson, json
+import bson, codecs, gzip, json
 import itertools
+import random
+import time
 
 from collections import defaultdict
 from urllib.parse import urljoin, urlparse
+from lace import logging
 from lace.logging import trace
 
+from unis.codec import codec
 from unis.settings import MIME
 
 class UnisError(Exception):
@@ -28,6 +32,57 @@ class ReferenceDict(dict):
             raise UnisReferenceError("No unis instance at requested location - {}".format(n), n)
 
 loop = asyncio.new_event_loop()
+_int = lambda v: int(v) if v not in (None, "") else None
+def _unpack(doc):
+    # A BSON document cannot be a list, arrays arrive keyed by their index
+    if isinstance(doc, dict) and doc and all(k.isdigit() for k in doc):
+        return [doc[k] for k in sorted(doc, key=int)]
+    return doc
+class _Payload(list):
+    """ Records decoded from one or more responses, with the bytes they took on the wire """
+    def __init__(self, records=(), nbytes=0):
+        super(_Payload, self).__init__(records)
+        self.nbytes = nbytes
+    @classmethod
+    def join(cls, parts):
+        records = list(itertools.chain(*parts))
+        if all(isinstance(p, cls) for p in parts):
+            return cls(records, sum(p.nbytes for p in parts))
+        return records
+
+async def _decode_stream(content, size=65536):
+    """ Decode a JSON array record by record as the body arrives """
+    decoder, text = json.JSONDecoder(), codecs.getincrementaldecoder('utf-8')()
+    buf, pos, opened, eof, result = "", 0, False, False, []
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buf):
+            if not opened:
+                if buf[pos] != '[':
+                    break
+                opened, pos = True, pos + 1
+                continue
+            if buf[pos] == ']':
+                return result
+            try:
+                v, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                end = None
+            if end is not None and (end < len(buf) or eof):
+                result.append(v)
+                pos = end
+                continue
+        if eof:
+            break
+        chunk = await content.read(size)
+        buf, pos, eof = buf[pos:] + text.decode(chunk, not chunk), 0, not chunk
+    # Not an array, decode whatever is left in one piece
+    while not eof:
+        chunk = await content.read(size)
+        buf, eof = buf + text.decode(chunk, not chunk), not chunk
+    return codec.loads(buf[pos:])
+
 class UnisProxy(object):
     @trace.debug("UnisProxy")
     def __init__(self, collection):
@@ -38,12 +93,19 @@ class UnisProxy(object):
     
     @trace.info("UnisProxy")
     def shutdown(self):
+        asyncio.get_event_loop().run_until_complete(self.ashutdown())
+    @trace.info("UnisProxy")
+    async def ashutdown(self):
         async def close():
             list(map(lambda t: t.cancel(), [t for t in asyncio.Task.all_tasks(loop) if t != asyncio.Task.current_task(loop)]))
             await asyncio.sleep(0.1)
             loop.stop()
         asyncio.run_coroutine_threadsafe(close(), loop)
-        asyncio.get_event_loop().run_until_complete(asyncio.gather(*[c.shutdown() for c in self.clients.values()]))
+        await asyncio.gather(*[c.shutdown() for c in self.clients.values()])
+    
+    @trace.info("UnisProxy")
+    def stats(self):
+        return { c._url: c.stats() for c in self.clients.values() }
     
     @trace.info("UnisProxy")
     def refToUID(self, source, full=True):
@@ -71,16 +133,28 @@ class UnisProxy(object):
         return await self._gather(self._collect_funcs(source, "getStubs"), self._name)
         
     @trace.info("UnisProxy")
-    async def get(self, source=None, ref=None, **kwargs):
-        return await self._gather(self._collect_funcs(source, "get"), ref or self._name, **kwargs)
+    async def get(self, source=None, ref=None, filters=None, **kwargs):
+        return await self._gather(self._collect_funcs(source, "get"), ref or self._name, filters=filters, **kwargs)
     
     @trace.info("UnisProxy")
-    async def post(self, resources):
+    def post(self, resources):
+        # Bodies are serialized on the caller's thread, the returned coroutine only sends them
         msgs = defaultdict(list)
         for r in resources:
-            msgs[self.refToUID(r.getSource(), False)[0]].append(r.to_JSON())
-        results = await asyncio.gather(*[self.clients[k].post(self._name, json.dumps(v)) for k,v in msgs.items()])
-        return list(itertools.chain(*[list(r) for r in results]))
+            msgs[self.refToUID(r.getSource(), False)[0]].append(r)
+        bodies = [(k, v, "[{}]".format(", ".join([r.serialize() for r in v]))) for k,v in msgs.items()]
+        async def send():
+            results = await asyncio.gather(*[self.clients[k].post(self._name, body) for k,_,body in bodies])
+            return self._accepted(zip([v for _,v,_ in bodies], results))
+        return send()
+    
+    @trace.info("UnisProxy")
+    def patch(self, resources, fields):
+        bodies = [(r, r.serialize(fields=fields[r])) for r in resources]
+        async def send():
+            results = await asyncio.gather(*[self.put(r.selfRef, body) for r,body in bodies])
+            return self._accepted(zip([[r] for r,_ in bodies], results))
+        return send()
     
     @trace.info("UnisProxy")
     async def put(self, href, data):
@@ -107,16 +181,136 @@ class UnisProxy(object):
     @trace.debug("UnisProxy")
     async def _gather(self, funcs, *args, **kwargs):
         results = await asyncio.gather(*[f(*args, **kwargs) for f in funcs])
-        return list(itertools.chain(*results))
+        return _Payload.join([_Payload() if isinstance(r, int) else r for r in results])
+    
+    @trace.debug("UnisProxy")
+    def _accepted(self, replies):
+        from unis.models.models import Context
+        # A bare status is a 2xx without a usable body, every resource sent with it was accepted
+        result = []
+        for sent, reply in replies:
+            result.extend([{ 'id': Context(r, None).id } for r in sent] if isinstance(reply, int) else reply)
+        return result
     
 
+def _latest(v):
+    if isinstance(v, dict):
+        return v['ts'] if isinstance(v.get('ts', None), (int, float)) else max([_latest(x) for x in v.values()] or [0])
+    elif isinstance(v, list):
+        return max([_latest(x) for x in v] or [0])
+    return 0
+
+class _Subscriptions(object):
+    """
+    Carries every subscribed channel of one source over a single websocket.
+    A dropped socket is reopened with exponential backoff, the channel queries
+    are sent again and anything missed while down is fetched with ts>last_seen.
+    All state is touched from the proxy loop only.
+    """
+    def __init__(self, client, loop, backoff=0.5, max_backoff=30, timeout=5):
+        self._client, self._loop = client, loop
+        self._backoff, self._max_backoff, self._timeout = backoff, max_backoff, timeout
+        self._channels, self._seen = defaultdict(list), {}
+        self._socket, self._task, self._closed = None, None, False
+        self.connects, self.errors = 0, 0
+    
+    def add(self, collection, callback):
+        self._loop.call_soon_threadsafe(self._add, collection, callback)
+    def close(self):
+        self._loop.call_soon_threadsafe(self._close)
+    
+    def _add(self, collection, callback):
+        if self._closed:
+            return
+        new = collection not in self._channels
+        self._channels[collection].append(callback)
+        self._seen.setdefault(collection, int(time.time() * 1000000))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        elif new and self._socket is not None:
+            asyncio.ensure_future(self._send(self._socket, collection))
+    def _close(self):
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+    
+    async def _send(self, socket, collection):
+        await socket.send(codec.dumps({'query':{}, 'resourceType': collection}))
+    async def _run(self):
+        delay = self._backoff
+        while not self._closed:
+            try:
+                socket = await asyncio.wait_for(self._client._connect(), self._timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exp:
+                self.errors += 1
+                logging.getLogger().warning("Cannot subscribe to {} - {}, retrying in {:.1f}s".format(self._client._url, exp, delay))
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+                delay = min(delay * 2, self._max_backoff)
+                continue
+            self._socket, delay = socket, self._backoff
+            try:
+                for collection in list(self._channels):
+                    await self._send(socket, collection)
+                if self.connects:
+                    await self._backfill()
+                self.connects += 1
+                while True:
+                    msg = codec.loads(await socket.recv())
+                    self._dispatch(msg['headers']['collection'], msg['data'], msg['headers']['action'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as exp:
+                self.errors += 1
+                logging.getLogger().warning("Subscription to {} lost - {}".format(self._client._url, exp))
+            finally:
+                self._socket = None
+                try:
+                    await socket.close()
+                except Exception:
+                    pass
+    async def _backfill(self):
+        for collection, seen in list(self._seen.items()):
+            records = await self._client.get(collection, ts="gt={}".format(seen))
+            if collection.startswith("data"):
+                self._dispatch(collection, { collection: records }, 'POST')
+            else:
+                for record in records:
+                    self._dispatch(collection, record, 'POST')
+    def _dispatch(self, collection, data, action):
+        self._seen[collection] = max(self._seen.get(collection, 0), _latest(data))
+        for cb in self._channels.get(collection, []):
+            try:
+                cb(data, action)
+            except Exception as exp:
+                logging.getLogger().warning("Subscription callback failed on {} - {}".format(collection, exp))
+
+class _PoolStats(object):
+    """ Counts new and reused connections for one source through aiohttp request tracing """
+    def __init__(self):
+        self.requests, self.created, self.reused = 0, 0, 0
+        self.trace = aiohttp.TraceConfig()
+        self.trace.on_request_start.append(self._request)
+        self.trace.on_connection_create_end.append(self._created)
+        self.trace.on_connection_reuseconn.append(self._reused)
+    async def _request(self, session, ctx, params):
+        self.requests += 1
+    async def _created(self, session, ctx, params):
+        self.created += 1
+    async def _reused(self, session, ctx, params):
+        self.reused += 1
+    def stats(self):
+        total = self.created + self.reused
+        return { "requests": self.requests, "new": self.created, "reused": self.reused, "reuse": self.reused / total if total else 0 }
+
 class _SingletonOnUUID(type):
     fqdns, instances = ReferenceDict(), {}
     def __init__(self, *args, **kwargs):
         return super(_SingletonOnUUID, self).__init__(*args, **kwargs)
     def __call__(cls, url, **kwargs):
-        if not hasattr(cls, '_session'):
-            cls._session, cls._shutdown = aiohttp.ClientSession(loop=asyncio.get_event_loop()), False
+        if not hasattr(cls, '_shutdown'):
+            cls._shutdown, cls._about = False, requests.Session()
         url = urlparse(url)
         authority = "{}://{}".format(url.scheme, url.netloc)
         uuid = cls.fqdns[url.netloc] = kwargs['uid'] = cls.fqdns.get(url.netloc, None) or cls.get_uuid(authority)
@@ -126,7 +320,7 @@ class _SingletonOnUUID(type):
     @classmethod
     def get_uuid(cls, url):
         headers = { 'Content-Type': 'application/perfsonar+json', 'Accept': MIME['PSJSON'] }
-        resp = requests.get(urljoin(url, "about"), headers=headers)
+        resp = cls._about.get(urljoin(url, "about"), headers=headers)
         if 200 <= resp.status_code <= 299:
             config = resp.json()
         else:
@@ -134,29 +328,45 @@ class _SingletonOnUUID(type):
         return config['uid']
 
 class UnisClient(metaclass=_SingletonOnUUID):
+    _URL_IDS, _COMPRESS_MIN = 6000, 1024
+    _wire, _compress, _compress_posts, _stream = "json", True, False, None
     @trace.debug("UnisClient")
     def __init__(self, url, loop, **kwargs):
-        def _handle_exception(future):
-            if not future.cancelled and future.exception():
-                raise future.exception()
-        async def _listen():
-            while True:
-                msg = json.loads(await self._socket.recv())
-                list(map(lambda cb: cb(msg['data'], msg['headers']['action']), self._channels[msg['headers']['collection']]))
-        async def _make_socket():
-            url = 'ws{}://{}/subscribe/nodes'.format("s" if self._ssl else "", urlparse(self._url).netloc)
-            return await websockets.connect(url, loop=loop, ssl=self._ssl)
         self.uid = kwargs['uid']
         self._url = url
         self._verify, self._ssl = kwargs.get("verify", False), kwargs.get("ssl", None)
-        self._socket = asyncio.run_coroutine_threadsafe(_make_socket(), loop).result(timeout=1)
-        self._channels = defaultdict(list)
-        asyncio.run_coroutine_threadsafe(_listen(), loop).add_done_callback(_handle_exception)
+        self._threads, self._batch, self._limits = int(kwargs.get("threads", 10)), int(kwargs.get("batch", 1000)), {}
+        self._pool = { "size": int(kwargs.get("pool_size", 0) or self._threads), "keepalive": float(kwargs.get("keepalive", 30)),
+                       "dns_ttl": _int(kwargs.get("dns_ttl", 300)) }
+        self._sessions, self._stats = {}, _PoolStats()
+        self._wire, self._compress = kwargs.get("wire", None) or "json", kwargs.get("compress", True)
+        self._compress_posts, self._stream = kwargs.get("compress_posts", False), _int(kwargs.get("stream_threshold", None))
+        self._subs = _Subscriptions(self, loop, float(kwargs.get("ws_backoff", 0.5)), float(kwargs.get("ws_max_backoff", 30)),
+                                    float(kwargs.get("ws_timeout", 5)))
+    
+    @property
+    def _session(self):
+        # Sessions are bound to a loop, requests may come from the caller's loop or the proxy's
+        loop = asyncio.get_event_loop()
+        if loop not in self._sessions:
+            pool = self._pool
+            connector = aiohttp.TCPConnector(limit=pool["size"], limit_per_host=pool["size"], keepalive_timeout=pool["keepalive"],
+                                             ttl_dns_cache=pool["dns_ttl"], loop=loop)
+            self._sessions[loop] = aiohttp.ClientSession(connector=connector, trace_configs=[self._stats.trace], loop=loop)
+        return self._sessions[loop]
+    
+    @trace.info("UnisClient")
+    def stats(self):
+        return self._stats.stats()
     
     @trace.debug("UnisClient")
     async def _do(self, f, *args, **kwargs):
-        async with f(*args, verify_ssl=self._verify, ssl_context=self._ssl, **kwargs) as resp:
-            return await self._check_response(resp, False)
+        loop = asyncio.get_event_loop()
+        if loop not in self._limits:
+            self._limits[loop] = asyncio.Semaphore(self._threads)
+        async with self._limits[loop]:
+            async with f(*args, verify_ssl=self._verify, ssl_context=self._ssl, **kwargs) as resp:
+                return await self._check_response(resp, False)
     
     @trace.info("UnisClient")
     async def getResources(self):
@@ -169,20 +379,25 @@ class UnisClient(metaclass=_SingletonOnUUID):
         return await self._do(self._session.get, url, headers=headers)
     
     @trace.info("UnisClient")
-    async def get(self, collection, **kwargs):
-        url, headers = self._get_conn_args(collection, **kwargs)
+    async def get(self, collection, filters=None, **kwargs):
+        batches = self._batches(kwargs.get("id", None))
+        if len(batches) > 1:
+            results = await asyncio.gather(*[self.get(collection, filters, **{**kwargs, "id": b}) for b in batches])
+            return _Payload.join(results)
+        # Filters name resource fields, so they are kept apart from the call's own parameters
+        url, headers = self._get_conn_args(collection, { **(filters or {}), **kwargs })
         return await self._do(self._session.get, url, headers=headers)
     
     @trace.info("UnisClient")
     async def post(self, collection, data):
         url, headers = self._get_conn_args(collection)
-        data = json.dumps(data) if isinstance(data, dict) else data
+        data = self._body(codec.dumps(data) if isinstance(data, dict) else data, headers)
         return await self._do(self._session.post, url, data=data, headers=headers)
     
     @trace.info("UnisClient")
     async def put(self, ref, data):
         url, headers = self._get_conn_args(ref)
-        data = json.dumps(data) if isinstance(data, dict) else data
+        data = self._body(codec.dumps(data) if isinstance(data, dict) else data, headers)
         return await self._do(self._session.put, url, data=data, headers=headers)
     
     @trace.info("UnisClient")
@@ -192,37 +407,73 @@ class UnisClient(metaclass=_SingletonOnUUID):
     
     @trace.info("UnisClient")
     async def subscribe(self, collection, callback):
-        async def _add_channel():
-            await self._socket.send(json.dumps({'query':{}, 'resourceType': collection}))
         if not self._shutdown:
-            self._channels[collection].append(callback)
-            asyncio.run_coroutine_threadsafe(_add_channel(), loop)
+            self._subs.add(collection, callback)
         return []
     
     @trace.debug("UnisClient")
-    def _get_conn_args(self, ref, **kwargs):
-        headers = { 'Content-Type': 'application/perfsonar+json', 'Accept': MIME['PSJSON'] }
+    async def _connect(self):
+        url = 'ws{}://{}/subscribe/nodes'.format("s" if self._ssl else "", urlparse(self._url).netloc)
+        return await websockets.connect(url, ssl=self._ssl)
+    
+    @trace.debug("UnisClient")
+    def _batches(self, ids):
+        if not isinstance(ids, list):
+            return [ids]
+        batches, size = [[]], 0
+        for v in ids:
+            if batches[-1] and (len(batches[-1]) >= self._batch or size + len(v) + 1 > self._URL_IDS):
+                batches.append([])
+                size = 0
+            batches[-1].append(v)
+            size += len(v) + 1
+        return batches
+    
+    @trace.debug("UnisClient")
+    def _body(self, data, headers):
+        if self._compress_posts and len(data) > self._COMPRESS_MIN:
+            headers['Content-Encoding'] = 'gzip'
+            return gzip.compress(data.encode('utf-8') if isinstance(data, str) else data)
+        return data
+    
+    @trace.debug("UnisClient")
+    def _get_conn_args(self, ref, query=None, **kwargs):
+        accept = "{}, {};q=0.9".format(MIME['PSBSON'], MIME['PSJSON']) if self._wire == "bson" else MIME['PSJSON']
+        headers = { 'Content-Type': 'application/perfsonar+json', 'Accept': accept,
+                    'Accept-Encoding': "gzip, deflate" if self._compress else "identity" }
         makelist = lambda v: ",".join(v) if isinstance(v, list) else v
-        params = "?{}".format("&".join(["=".join([k, makelist(v)]) for k,v in kwargs.items() if v]))
+        params = "?{}".format("&".join(["=".join([k, makelist(v)]) for k,v in { **(query or {}), **kwargs }.items() if v]))
         return urljoin(self._url, "{}{}".format(urlparse(ref).path, params if params[1:] else "")), headers
     
     @trace.debug("UnisClient")
     async def _check_response(self, r, read_as_bson=True):
         if 200 <= r.status <= 299:
             try:
-                body = await r.read()
-                resp = bson.loads(body) if r.content_type == MIME['PSBSON'] else json.loads(str(body, 'utf-8'))
-                return resp if isinstance(resp, list) else [resp]
+                if r.content_type == MIME['PSBSON']:
+                    body = await r.read()
+                    resp, size = _unpack(bson.loads(body)), len(body)
+                elif self._stream is not None and (r.content_length is None or r.content_length > self._stream):
+                    resp, size = await _decode_stream(r.content), r.content.total_bytes
+                else:
+                    body = await r.read()
+                    resp, size = codec.loads(body), len(body)
+                # Content-Length is the size on the wire, before any gzip is undone
+                return _Payload(resp if isinstance(resp, list) else [resp], r.content_length or size)
             except Exception as exp:
                 return r.status
         elif 400 <= r.status <= 499:
-            raise Exception("Error from unis server [bad request] - [{exp}] {t}".format(exp = r.status, t = r.text))
+            raise ConnectionError("Error from unis server [bad request] - [{exp}] {t}".format(exp = r.status, t = r.text), r.status)
         else:
-            raise Exception("Error from unis server - [{exp}] {t}".format(exp = r.status, t = r.text))
+            raise ConnectionError("Error from unis server - [{exp}] {t}".format(exp = r.status, t = r.text), r.status)
     
     async def shutdown(self):
         self._shutdown = True
-        if not self._session.closed:
-            await self._session.close()
-        if self._socket:
-            self._socket.close()
+        current = asyncio.get_event_loop()
+        for l, session in list(self._sessions.items()):
+            if session.closed:
+                continue
+            if l is current:
+                await session.close()
+            elif l.is_running():
+                asyncio.run_coroutine_threadsafe(session.close(), l)
+        self._subs.close()
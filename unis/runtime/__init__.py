@@ -1 +1 @@
-from unis.runtime.runtime import Runtime
+from unis.runtime.runtime import AsyncRuntime, Runtime
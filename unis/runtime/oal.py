@@ -1,20 +1,77 @@
 import asyncio
+import itertools
+import random
+import threading
 import uuid
 
-from collections import defaultdict
+from aiohttp import ClientError
+from collections import OrderedDict, defaultdict
+from lace import logging
 from lace.logging import trace
 
 from unis.models import schemaLoader
 from unis.models.lists import UnisCollection
-from unis.models.models import Context
-from unis.rest import UnisReferenceError, UnisProxy
+from unis.models.models import Context, UnisObject, validate_many
+from unis.rest import UnisError, UnisReferenceError, UnisProxy
+from unis.rest.unis_client import ConnectionError as UnisConnectionError, loop as proxy_loop
+from unis.utils import Events, children
 
 from urllib.parse import urlparse
 
+class _WriteBehind(object):
+    """
+    Flushes the object layer's pending resources from the proxy's event loop
+    once `size` resources are waiting or the oldest has waited `age` seconds.
+    Flushes never overlap, so each resource has at most one write in flight.
+    Nobody waits on a triggered flush, so a failure is logged and the timer
+    re-armed for whatever is still pending.
+    """
+    def __init__(self, layer, size, age):
+        self._layer, self._size, self._age = layer, size, age
+        self._timer, self._lock, self._kicked = None, None, False
+    
+    def notify(self, pending):
+        if pending >= self._size and not self._kicked:
+            self._kicked = True
+            self._submit()
+        elif pending == 1:
+            proxy_loop.call_soon_threadsafe(self._arm)
+    def flush(self):
+        self._submit().result()
+    
+    def _arm(self):
+        if self._timer is None:
+            self._timer = proxy_loop.call_later(self._age, self._submit)
+    def _submit(self):
+        future = asyncio.run_coroutine_threadsafe(self._run(), proxy_loop)
+        future.add_done_callback(self._done)
+        return future
+    def _done(self, future):
+        if future.cancelled() or not future.exception():
+            return
+        logging.getLogger().warning("Write behind flush failed - {}".format(future.exception()))
+        if self._layer._pending:
+            proxy_loop.call_soon_threadsafe(self._arm)
+    async def _run(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer, self._kicked = None, False
+            if self._layer._pending:
+                await self._layer._flush()
+
 class ObjectLayer(object):
     @trace.debug("OAL")
     def __init__(self, runtime):
-        self.settings, self._cache, self._pending = runtime.settings, {}, set()
+        self.settings, self._cache, self._pending, self._inflight = runtime.settings, {}, set(), set()
+        # _lock is shared with the collections, flushes may run on the proxy's thread
+        self._pending_lock, self._lock = threading.Lock(), threading.RLock()
+        self._attempts, self._dead, self._models, self._bulk, self._tasks = {}, [], {}, False, set()
+        self._staged = None
+        proxy = self.settings['proxy']
+        self._writer = _WriteBehind(self, int(proxy.get('flush_size', 1000)), float(proxy.get('flush_age', 1))) if proxy.get('write_behind', False) else None
     
     def __getattr__(self, n):
         try:
@@ -27,83 +84,318 @@ class ObjectLayer(object):
     
     @trace.debug("OAL")
     def find(self, href):
-        try:
-            return self._cache[urlparse(href).path.split('/')[1]].get(href)
-        except UnisReferenceError as e:
-            new_source = { 'url': "http://" + e.href, 'default': False, 'enabled': True }
-            self.addSources([new_source])
-            return self._cache[urlparse(href).path.split('/')[1]].get(href)
+        # References are resolved here during attribute access, so a cached hit must not touch the loop
+        hrefs, groups, found = href if isinstance(href, list) else [href], defaultdict(list), {}
+        for h in hrefs:
+            groups[urlparse(h).path.split('/')[1]].append(h)
+        for name, refs in groups.items():
+            while True:
+                try:
+                    found.update(zip(refs, self._cache[name].get(refs)))
+                    break
+                except UnisReferenceError as e:
+                    if not isinstance(e.href, str):
+                        raise
+                    new_source = { 'url': "http://" + e.href, 'default': False, 'enabled': True }
+                    self.addSources([new_source])
+        return [found[h] for h in hrefs]
+    @trace.debug("OAL")
+    async def afind(self, href):
+        hrefs, groups, found = href if isinstance(href, list) else [href], defaultdict(list), {}
+        for h in hrefs:
+            groups[urlparse(h).path.split('/')[1]].append(h)
+        for name, refs in groups.items():
+            while True:
+                try:
+                    found.update(zip(refs, await self._cache[name].aget(refs)))
+                    break
+                except UnisReferenceError as e:
+                    if not isinstance(e.href, str):
+                        raise
+                    new_source = { 'url': "http://" + e.href, 'default': False, 'enabled': True }
+                    await self.aaddSources([new_source])
+        return [found[h] for h in hrefs]
+    
+    @trace.info("OAL")
+    def prefetch(self, resources, paths):
+        asyncio.get_event_loop().run_until_complete(self.aprefetch(resources, paths))
+    @trace.info("OAL")
+    async def aprefetch(self, resources, paths):
+        resources = resources if isinstance(resources, list) else [resources]
+        for path in ([paths] if isinstance(paths, str) else paths):
+            level = [r.getObject() if isinstance(r, Context) else r for r in resources]
+            for n in path.split('.'):
+                hrefs, resolved = [], []
+                for v in children(level, n):
+                    if isinstance(v, UnisObject):
+                        resolved.append(v)
+                    elif isinstance(v, dict) and 'href' in v and '$schema' not in v:
+                        hrefs.append(v['href'])
+                found = (await self.afind(list(OrderedDict.fromkeys(hrefs)))) if hrefs else []
+                level = resolved + [v.getObject() if isinstance(v, Context) else v for v in found if v is not None]
+    
+    @trace.info("OAL")
+    def addDeadLetter(self, fn):
+        self._dead.append(fn)
     
     @trace.info("OAL")
     def flush(self):
-        if self._pending:
-            cols = defaultdict(list)
-            list(map(lambda r: cols[r.getCollection().name].append(r), self._pending))
-            asyncio.get_event_loop().run_until_complete(asyncio.gather(*[self._do_update(v,k) for k,v in cols.items()]))
-        
+        asyncio.get_event_loop().run_until_complete(self.aflush())
+    @trace.info("OAL")
+    async def aflush(self):
+        if self._tasks:
+            # Tasks stranded on a closed loop never ran, their resources are still pending
+            loop = asyncio.get_event_loop()
+            await asyncio.gather(*[t for t in list(self._tasks) if t.get_loop() is loop])
+        if self._writer:
+            await asyncio.wrap_future(self._writer._submit())
+        elif self._pending:
+            await self._flush()
+    
     @trace.info("OAL")
     def update(self, resource):
         if resource.selfRef:
-            if resource.getObject() not in self._pending:
+            with self._pending_lock:
+                queued, pending = resource.getObject() not in self._pending, len(self._pending) + 1
                 self._pending.add(resource.getObject())
-                if not self.settings['proxy']['defer_update']:
-                    asyncio.get_event_loop().run_until_complete(self._do_update([resource], resource.getCollection().name))
-                
+            if queued:
+                if self._writer:
+                    self._writer.notify(pending)
+                elif not self.settings['proxy']['defer_update'] and not self._bulk:
+                    self._run(self._do_update([resource], resource.getCollection().name))
+    
+    def pinned(self, resource):
+        # Collections must not evict a resource until its write has landed
+        return resource in self._pending or resource in self._inflight
+    def _take(self, resources=None):
+        # Callers add to _pending while the flush runs on another loop, swap in place under the lock
+        with self._pending_lock:
+            resources = set(self._pending) if resources is None else resources
+            self._pending.difference_update(resources)
+            self._inflight.update(resources)
+        return resources
+    
+    def _run(self, coro):
+        # From a running loop the work is scheduled and awaited by the next aflush
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            return loop.run_until_complete(coro)
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+    
+    @trace.debug("OAL")
+    async def _flush(self):
+        while self._pending:
+            resources = self._take()
+            cols = defaultdict(list)
+            list(map(lambda r: cols[r.getCollection().name].append(r), resources))
+            results = await asyncio.gather(*[self._do_update(v,k) for k,v in cols.items()], return_exceptions=True)
+            errors = [e for e in results if isinstance(e, Exception)]
+            if errors:
+                raise errors[0]
+            requeued = list(itertools.chain(*results))
+            if not requeued:
+                break
+            await asyncio.sleep(self._backoff(max(self._attempts.get(r, 1) for r in requeued) - 1))
+    
     @trace.debug("OAL")
     async def _do_update(self, resources, collection):
-        self._cache[collection].locked = True
-        response = []
-        map(lambda x: x.validate(), resources)
+        resources = self._take([r.getObject() if isinstance(r, Context) else r for r in resources])
+        with self._lock:
+            invalid = validate_many(resources, self, strict=False)
+        if invalid:
+            self._landed(invalid)
+            resources = [r for r in resources if r not in invalid]
+        col, batch, groups = self._cache[collection], int(self.settings['proxy'].get('batch', 1000)), defaultdict(list)
+        partial = self.settings['proxy'].get('partial_update', False)
+        for r in resources:
+            # Only documents the server already holds can take a partial PUT, new ones are posted whole
+            groups[(Context(r, self).getSource(), partial and r._rt_stored)].append(r)
+        batches = [(k[1], v[i:i + batch]) for k,v in groups.items() for i in range(0, len(v), batch)]
+        col.locked = True
         try:
-            response = await self._cache[collection]._unis.post(resources)
-        except:
-            raise
+            results = await asyncio.gather(*[self._post(b, col, p) for p,b in batches], return_exceptions=True)
         finally:
-            response = response if isinstance(response, list) else [response]
+            col.locked = False
+            self._landed(resources)
+        # Valid resources are sent first, then each invalid one fails with its own error
+        for r, exp in invalid.items():
+            try:
+                with self._lock:
+                    self._fail([r], exp)
+            except Exception as e:
+                results.append(e)
+        errors = [e for e in results if isinstance(e, Exception)]
+        if errors:
+            raise errors[0]
+        return list(itertools.chain(*results))
+    
+    @trace.debug("OAL")
+    async def _post(self, resources, col, partial=False):
+        retries = int(self.settings['proxy'].get('retries', 3))
+        with self._lock:
+            dirty = {r: r._rt_dirty or set() for r in resources}
             for r in resources:
-                r = Context(r, self)
-                resp = next(o for o in response if o['id'] == r.id)
-                r.__dict__["selfRef"] = resp["selfRef"]
-                self._cache[collection].updateIndex(r)
-            list(map(self._pending.remove, resources))
-            self._cache[collection].locked = False
+                r._rt_dirty = None
+        for attempt in itertools.count():
+            try:
+                # Bodies are serialized under the lock, only the requests run outside it
+                with self._lock:
+                    request = col._unis.patch(resources, dirty) if partial else col._unis.post(resources)
+                response = await request
+                break
+            except Exception as exp:
+                if attempt < retries and self._retryable(exp):
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+                with self._lock:
+                    for r in resources:
+                        r._rt_dirty = dirty[r] | (r._rt_dirty or set())
+                    self._fail(resources, exp)
+                return []
+        
+        response = { o['id']: o for o in (response if isinstance(response, list) else [response]) if isinstance(o, dict) and 'id' in o }
+        rejected = []
+        with self._lock:
+            for r in resources:
+                ctx = Context(r, self)
+                if ctx.id in response:
+                    self._attempts.pop(r, None)
+                    r._rt_stored = True
+                    if 'selfRef' in response[ctx.id]:
+                        r._set_selfref(response[ctx.id]['selfRef'])
+                    col.updateIndex(ctx)
+                    r._callback(Events.commit.name)
+                else:
+                    r._rt_dirty = dirty[r] | (r._rt_dirty or set())
+                    self._attempts[r] = self._attempts.get(r, 0) + 1
+                    rejected.append(r)
+            requeued = [r for r in rejected if self._attempts[r] <= retries]
+            with self._pending_lock:
+                self._pending.update(requeued)
+            dead = [r for r in rejected if self._attempts[r] > retries]
+            if dead:
+                self._fail(dead, UnisError("Resources rejected by unis after {} attempts".format(retries + 1)))
+        return requeued
+    
+    def _landed(self, resources):
+        with self._pending_lock:
+            self._inflight.difference_update(resources)
+    
+    def _retryable(self, exp):
+        if isinstance(exp, UnisConnectionError):
+            return not (isinstance(exp.status, int) and 400 <= exp.status <= 499)
+        return isinstance(exp, (ClientError, asyncio.TimeoutError, OSError))
+    def _backoff(self, attempt):
+        proxy = self.settings['proxy']
+        delay = min(float(proxy.get('backoff', 0.1)) * 2 ** attempt, float(proxy.get('max_backoff', 5)))
+        return delay * random.uniform(0.5, 1)
+    def _fail(self, resources, exp):
+        for r in resources:
+            self._attempts.pop(r, None)
+            r._callback(Events.error.name)
+        if not self._dead:
+            raise exp
+        for fn in self._dead:
+            fn([Context(r, self) for r in resources], exp)
     
     @trace.info("OAL")
     def addSources(self, hrefs):
-        loop = asyncio.get_event_loop()
+        asyncio.get_event_loop().run_until_complete(self.aaddSources(hrefs))
+    @trace.info("OAL")
+    async def aaddSources(self, hrefs):
+        options = ["threads", "batch", "pool_size", "keepalive", "dns_ttl", "wire", "compress", "compress_posts", "stream_threshold",
+                   "ws_backoff", "ws_max_backoff", "ws_timeout"]
+        limits = { k: self.settings['proxy'][k] for k in options if k in self.settings['proxy'] }
+        hrefs = [{ **limits, **h } for h in hrefs]
         proxy = UnisProxy(None)
-        proxy.addSources(hrefs)
-        for r in loop.run_until_complete(proxy.getResources()):
+        # Connecting a client blocks on its handshake, keep that off the caller's loop
+        await asyncio.get_event_loop().run_in_executor(None, proxy.addSources, hrefs)
+        for r in await proxy.getResources():
             ref = (urlparse(r['href']).path.split('/')[1], r['targetschema']['items']['href'])
             if ref[0] not in ['events', 'data']:
                 col = UnisCollection.get_collection(ref[0], schemaLoader.get_class(ref[1], raw=True), self)
                 self._cache[col.name] = col
-        loop.run_until_complete(asyncio.gather(*[c.addSources(hrefs) for c in self._cache.values()]))
+        await asyncio.gather(*[c.addSources(hrefs) for c in self._cache.values()])
+    
+    @trace.info("OAL")
+    def poolStats(self):
+        stats = {}
+        for c in self._cache.values():
+            stats.update(c._unis.stats())
+        return stats
     
     @trace.info("OAL")
     def preload(self):
+        asyncio.get_event_loop().run_until_complete(self.apreload())
+    @trace.info("OAL")
+    async def apreload(self):
         _p = lambda c: c.name in self.settings['cache']['preload'] or self.settings['cache']['mode'] == 'greedy'
         futures = [c._complete_cache() for c in self._cache.values() if _p(c)]
-        asyncio.get_event_loop().run_until_complete(asyncio.gather(*futures))
-        
+        await asyncio.gather(*futures)
+    
     @trace.info("OAL")
-    def insert(self, res, uid=None):
-        try:
-            res = schemaLoader.get_class(res["$schema"]) if isinstance(res, dict) else res
-        except KeyError:
-            raise ValueError("No schema in dict, cannot continue")
-            
+    def insert(self, res, uid=None, commit=False, publish_to=None):
+        res = self._resource(res)
         res.id = uid or res.id or str(uuid.uuid4())
         res.setRuntime(self)
+        if self._staged is not None:
+            # Inserts made from the callbacks of a bulk insert follow it as one batch
+            self._staged[(commit, publish_to)].append(res)
+            return res
         self._cache[self.getModel(res.names)].append(res.getObject())
+        if commit:
+            res.commit(publish_to=publish_to)
         return res
-        
+    
     @trace.info("OAL")
-    def getModel(self, names):
+    def insert_many(self, resources, commit=False, publish_to=None):
+        groups, result = defaultdict(list), []
+        for res in resources:
+            res = self._resource(res)
+            if not res.id:
+                res.id = str(uuid.uuid4())
+            res.setRuntime(self)
+            groups[self.getModel(res.names)].append(res.getObject())
+            result.append(res)
+        staged, self._staged = self._staged, defaultdict(list)
         try:
-            return next(c.name for c in self._cache.values() if c.model._rt_schema["name"] in list(names))
-        except StopIteration:
-            raise ValueError("Resource type {n} not found in ObjectLayer".format(n=names))
+            for name, items in groups.items():
+                self._cache[name].extend(items)
+        finally:
+            nested, self._staged = self._staged, staged
+        if commit:
+            self._bulk = True
+            try:
+                for res in result:
+                    res.commit(publish_to=publish_to)
+            finally:
+                self._bulk = False
+            if not self.settings['proxy']['defer_update'] and self._pending:
+                self._run(self._flush())
+        for (c, p), items in nested.items():
+            self.insert_many(items, commit=c, publish_to=p)
+        return result
+    
+    def _resource(self, res):
+        if isinstance(res, dict):
+            try:
+                return schemaLoader.get_class(res["$schema"])(res)
+            except KeyError:
+                raise ValueError("No schema in dict, cannot continue")
+        return res
+    
+    @trace.info("OAL")
+    def getModel(self, names):
+        key = tuple(names)
+        if key not in self._models:
+            try:
+                self._models[key] = next(c.name for c in self._cache.values() if c.model._rt_schema["name"] in key)
+            except StopIteration:
+                raise ValueError("Resource type {n} not found in ObjectLayer".format(n=names))
+        return self._models[key]
     
     @trace.info("OAL")
     def about(self):
@@ -111,8 +403,11 @@ class ObjectLayer(object):
     
     @trace.info("OAL")
     def shutdown(self):
-        self.flush()
-        list(map(lambda p: p._unis.shutdown(), self._cache.values()))
+        asyncio.get_event_loop().run_until_complete(self.ashutdown())
+    @trace.info("OAL")
+    async def ashutdown(self):
+        await self.aflush()
+        await asyncio.gather(*[c._unis.ashutdown() for c in self._cache.values()])
     @trace.debug("OAL")
     def __contains__(self, resource):
         try:
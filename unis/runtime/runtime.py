@@ -1,3 +1,4 @@
+import asyncio
 import atexit
 import configparser
 import copy
@@ -9,6 +10,8 @@ from lace.logging import trace
 from lace import logging
 
 from unis import settings
+from unis.codec import codec
+from unis.models.lists import UnisCollection
 from unis.services import RuntimeService
 from unis.runtime.oal import ObjectLayer
 
@@ -33,6 +36,15 @@ class Runtime(object):
     
     @trace.debug("Runtime")
     def __init__(self, unis=None, **kwargs):
+        self._configure(unis, **kwargs)
+        
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        atexit.register(self.shutdown)
+        
+        asyncio.get_event_loop().run_until_complete(self._start())
+    
+    def _configure(self, unis, **kwargs):
         def _unis_config(unis):
             if not isinstance(unis, dict):
                 unis = { "url": unis, "default": False, "verify": False, "ssl": None, "enabled": True }
@@ -43,10 +55,6 @@ class Runtime(object):
         self.build_settings()
         self._services = []
         
-        signal.signal(signal.SIGINT, self.shutdown)
-        signal.signal(signal.SIGTERM, self.shutdown)
-        atexit.register(self.shutdown)
-        
         if unis:
             unis = unis if isinstance(unis, list) else [unis]
             for new in unis:
@@ -61,11 +69,13 @@ class Runtime(object):
         for k,v in kwargs.items():
             self.settings[k] = {**self.settings[k], **v} if isinstance(v, dict) else v 
         
+        codec.use(self.settings['proxy'].get('codec', 'auto'))
         self.settings['default_source'] = reduce(lambda x,y: y if y['default'] else x, self.settings['unis'])['url']
         self._oal = ObjectLayer(self)
-        
-        self._oal.addSources(self.settings['unis'])
-        self._oal.preload()
+    
+    async def _start(self):
+        await self._oal.aaddSources(self.settings['unis'])
+        await self._oal.apreload()
         list(map(self.addService, self.settings['services']))
         
     def __getattr__(self, n):
@@ -85,10 +95,11 @@ class Runtime(object):
     
     @trace.info("Runtime")
     def insert(self, resource, commit=False, publish_to=None):
-        if commit:
-            self._oal.insert(resource).commit(publish_to=publish_to)
-            return resource
-        return self._oal.insert(resource)
+        return self._oal.insert(resource, commit=commit, publish_to=publish_to)
+    
+    @trace.info("Runtime")
+    def insert_many(self, resources, commit=False, publish_to=None):
+        return self._oal.insert_many(resources, commit=commit, publish_to=publish_to)
     
     @trace.info("Runtime")
     def addService(self, service):
@@ -127,3 +138,63 @@ class Runtime(object):
         return self
     def __exit__(self, type, value, traceback):
         self.shutdown()
+
+class AsyncRuntime(Runtime):
+    """
+    Runtime for code already running an event loop.  Construction only reads
+    the configuration, connect with `await rt.start()` or `async with` and
+    close with `await rt.ashutdown()`.  Collections are returned as awaitable
+    views, e.g. `await rt.nodes.load()`, and references that are not cached
+    must be resolved with `await rt.find()` or `await rt.prefetch()`.
+    """
+    @trace.debug("AsyncRuntime")
+    def __init__(self, unis=None, **kwargs):
+        self._configure(unis, **kwargs)
+    
+    def __getattr__(self, n):
+        v = super(AsyncRuntime, self).__getattr__(n)
+        return UnisCollection.AsyncContext(v._obj, v._rt) if isinstance(v, UnisCollection.Context) else v
+    
+    @trace.info("AsyncRuntime")
+    async def start(self):
+        await self._start()
+        atexit.register(self.shutdown)
+        return self
+    
+    @trace.info("AsyncRuntime")
+    async def find(self, href):
+        return await self._oal.afind(href)
+    
+    @trace.info("AsyncRuntime")
+    async def prefetch(self, resources, paths):
+        await self._oal.aprefetch(resources, paths)
+    
+    @trace.info("AsyncRuntime")
+    async def flush(self):
+        await self._oal.aflush()
+    
+    @trace.info("AsyncRuntime")
+    def shutdown(self):
+        # Sync teardown for atexit, the caller's loop is gone by then so run on a fresh one
+        if getattr(self, "_oal", None):
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self.ashutdown())
+            finally:
+                loop.close()
+    @trace.info("AsyncRuntime")
+    async def ashutdown(self):
+        self.log.info("Tearing down connection to UNIS...")
+        atexit.unregister(self.shutdown)
+        if getattr(self, "_oal", None):
+            await self._oal.ashutdown()
+            self._oal = None
+        self.log.info("Teardown complete.")
+    def __enter__(self):
+        raise TypeError("AsyncRuntime is used with `async with`")
+    def __exit__(self, type, value, traceback):
+        pass
+    async def __aenter__(self):
+        return await self.start()
+    async def __aexit__(self, type, value, traceback):
+        await self.ashutdown()
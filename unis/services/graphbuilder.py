@@ -41,27 +41,32 @@ class Graph(object):
         return result
     
     def createVertex(self):
+        n = self._vertex()
+        self._rt.insert_many([n])
+        return n
+        
+    def createEdge(self, src, dst):
+        self._rt.insert_many(self._edge(src, dst))
+    
+    def _vertex(self):
         n = Node({ "name": "{}{}".format(self.prefix, len(self.vertices)) })
         n.svg = {}
-        self._rt.insert(n)
         self.vertices.append(n)
         return n
-        
-    def createEdge(self, src, dst):
-        p_src = Port({"index": str(len(src.ports)) })
-        p_dst = Port({"index": str(len(dst.ports)) })
+    
+    def _edge(self, src, dst):
+        p_src = Port({"index": str(len(src.ports.getObject())) })
+        p_dst = Port({"index": str(len(dst.ports.getObject())) })
         p_src.address.address = self.subnet.format(*self._nextaddr())
         p_src.address.type = "ipv4"
         p_dst.address.address = self.subnet.format(*self._nextaddr())
         p_dst.address.type = "ipv4"
-        self._rt.insert(p_src)
-        self._rt.insert(p_dst)
         l = Link({ "directed": False, "endpoints": [p_src, p_dst] })
-        self._rt.insert(l)
         src.ports.append(p_src)
         dst.ports.append(p_dst)
         self.edges.append((src, dst))
         self.edges.append((dst, src))
+        return [p_src, p_dst, l]
     
     def finalize(self, include_svg=False):
         for n in self.vertices:
@@ -239,14 +244,16 @@ class Graph(object):
         links = size
         adj = {}
         missing = []
-        g = Graph(prefix=prefix)
-        g.createVertex()
+        g = Graph(db=db, subnet=subnet, prefix=prefix)
+        # The whole graph is built locally and handed to the runtime in one batch
+        new = [g._vertex()]
         
         for i in range(size - 1):
             neighbor = random.randrange(0, len(g.vertices))
-            n = g.createVertex()
+            n = g._vertex()
             adj[i] = neighbor
-            g.createEdge(n, g.vertices[neighbor])
+            new.append(n)
+            new.extend(g._edge(n, g.vertices[neighbor]))
             
         for a in range(size):
             for b in range(a + 1, size):
@@ -254,10 +261,11 @@ class Graph(object):
                     missing.append((a, b))
         while links <= count and missing:
             a, b = random.choice(missing)
-            g.createEdge(g.vertices[a], g.vertices[b])
+            new.extend(g._edge(g.vertices[a], g.vertices[b]))
             missing.remove((a, b))
             links += 1
         
+        g._rt.insert_many(new)
         return g
         
     @classmethod
@@ -20,6 +20,8 @@ if RTUSER_ROOT == "$RTUSER_ROOT":
     RTUSER_ROOT = os.path.expanduser("~/.unis")
 
 SCHEMA_CACHE_DIR = os.path.join(RTUSER_ROOT, ".cache")
+SCHEMA_CACHE_FILE = os.path.join(SCHEMA_CACHE_DIR, "schemas.cache")
+SCHEMA_TIMEOUT = 10
 SCHEMA_HOST        = 'unis.crest.iu.edu'
 
 _schema = "http://{host}/schema/{directory}/{name}"
@@ -62,12 +64,40 @@ DEFAULT_CONFIG = {
         "preload": [ "nodes", "links" ],
         "mode": "exponential",
         "growth": 2,
+        "paging": "exponential",
+        "page_size": 10,
+        "page_limit": 1000,
+        "target_latency": 0.5,
+        "target_bytes": 1048576,
+        "pushdown": True,
+        "prefetch": 2,
+        "eviction": None,
+        "max_entries": None,
+        "max_bytes": None,
     },
     "proxy": {
         "threads": 10,
         "batch": 1000,
+        "pool_size": None,
+        "keepalive": 30,
+        "dns_ttl": 300,
+        "wire": "json",
+        "compress": True,
+        "compress_posts": False,
+        "stream_threshold": None,
+        "codec": "auto",
+        "ws_backoff": 0.5,
+        "ws_max_backoff": 30,
+        "ws_timeout": 5,
         "subscribe": True,
         "defer_update": True,
+        "partial_update": False,
+        "write_behind": False,
+        "flush_size": 1000,
+        "flush_age": 1,
+        "retries": 3,
+        "backoff": 0.1,
+        "max_backoff": 5,
     },
     "measurements": {
         "read_history": True,
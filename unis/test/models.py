@@ -17,16 +17,21 @@
 UNIS model related tests
 """
 
+import asyncio
 import collections
 import copy
+import json
 import unittest
 import unittest.mock as mock
 from unittest.mock import MagicMock, Mock
 
-from unis.models.settings import SCHEMAS
-from unis.models import Node, Exnode, Extent
-from unis.models.models import CACHE, UnisObject, UnisList, schemaLoader, LocalObject
-from unis.models.lists import UnisCollection
+from unis.settings import SCHEMAS
+from unis.models import Node, Link, Exnode, Extent, schemaLoader
+from unis.models.models import UnisObject, List as UnisList, Local as LocalObject
+from unis.models.models import Context, validate_many
+from unis.models.lists import UnisCollection, _Eviction, _Pager, _Query, _slotmap
+from unis.rest.unis_client import _Payload, ConnectionError as UnisConnectionError
+from unis.utils import Index
 
 class UnisObjectTest(unittest.TestCase):
     def test_init(self):
@@ -139,7 +144,7 @@ class NetworkResourceTest(unittest.TestCase):
         self.assertIsInstance(node2, Node)
         self.assertEqual(getattr(node1, '$schema'), SCHEMAS['Node'])
         self.assertEqual(getattr(node2, '$schema'), SCHEMAS['Node'])
-        self.assertEqual(node1._schema, CACHE[SCHEMAS['Node']])
+        self.assertEqual(node1._rt_schema['id'], SCHEMAS['Node'])
         
     def test_validate(self):
         from jsonschema.exceptions import ValidationError
@@ -203,6 +208,748 @@ class NetworkResourceTest(unittest.TestCase):
         # Assert
         runtime.find.assert_called_once_with("test")
         
+class LazyObjectTest(unittest.TestCase):
+    DOC = { "$schema": SCHEMAS["Node"], "id": "1", "ports": [{ "href": "http://localhost:8888/ports/1", "rel": "full" }],
+            "properties": { "geni": { "client_id": "a", "slivers": [1, 2, { "v": 3 }] } } }
+    
+    def _make(self):
+        model = schemaLoader.get_class(SCHEMAS["Node"], raw=True)
+        return Context(model(copy.deepcopy(self.DOC), lazy=True), None)
+    
+    def test_untouched_raw(self):
+        # Arrange
+        n = self._make()
+        
+        # Act
+        result = n.to_JSON()
+        
+        # Assert
+        self.assertEqual(result["properties"], self.DOC["properties"])
+        self.assertEqual(result["ports"], self.DOC["ports"])
+        self.assertIsInstance(n.getObject().__dict__["properties"], dict)
+    
+    def test_lift_touched_only(self):
+        # Arrange
+        n = self._make()
+        
+        # Act
+        n.properties.geni.client_id = "b"
+        
+        # Assert
+        geni = n.getObject().__dict__["properties"].__dict__["geni"]
+        self.assertIsInstance(geni.__dict__["slivers"], list)
+        self.assertEqual(n.to_JSON()["properties"]["geni"], { "client_id": "b", "slivers": [1, 2, { "v": 3 }] })
+    
+    def test_iter_lift_once(self):
+        # Arrange
+        n = self._make()
+        
+        # Act
+        first = [v for v in n.properties.geni.slivers]
+        second = [v for v in n.properties.geni.slivers]
+        
+        # Assert
+        self.assertEqual(first[:2], [1, 2])
+        self.assertIs(first[2], second[2])
+    
+class ContextTest(unittest.TestCase):
+    def test_wrapper_cached(self):
+        # Arrange
+        rt = MagicMock()
+        n = Node({"id": "1", "ports": []})
+        
+        # Act
+        a, b = Context(n.getObject(), rt), Context(n.getObject(), rt)
+        
+        # Assert
+        self.assertIs(a, b)
+        self.assertIs(Context(n.getObject(), None), n)
+        self.assertIsNot(a, n)
+        self.assertIs(n.ports, n.ports)
+    
+    def test_set_runtime(self):
+        # Arrange
+        rt = MagicMock()
+        n = Node({"id": "1"})
+        
+        # Act
+        n.setRuntime(rt)
+        
+        # Assert
+        self.assertIs(n.getRuntime(), rt)
+        self.assertIs(Context(n.getObject(), rt), n)
+        self.assertIsNot(Context(n.getObject(), None), n)
+    
+    def test_method_bound_once(self):
+        # Arrange
+        n = Node({"id": "1"})
+        
+        # Act
+        f = n.getCollection
+        
+        # Assert
+        self.assertIs(f, n.getCollection)
+        self.assertEqual(f(), None)
+    
+    def test_lift_once(self):
+        # Arrange
+        n = Node({"id": "1", "name": "a"})
+        
+        # Act
+        n.name
+        lifted = n.getObject().__dict__["name"]
+        
+        # Assert
+        self.assertEqual(n.name, "a")
+        self.assertIs(n.getObject().__dict__["name"], lifted)
+    
+class SerializeTest(unittest.TestCase):
+    DOC = { "$schema": SCHEMAS["Node"], "id": "1", "ts": 1, "name": "a",
+            "properties": { "geni": { "client_id": "a", "slivers": [1, 2] } } }
+    
+    def _make(self):
+        model = schemaLoader.get_class(SCHEMAS["Node"], raw=True)
+        return Context(model(copy.deepcopy(self.DOC), lazy=True), None)
+    
+    def test_serialize_matches_json(self):
+        # Arrange
+        n = self._make()
+        
+        # Act
+        result = json.loads(n.serialize())
+        
+        # Assert
+        self.assertEqual(result, n.to_JSON())
+    
+    def test_fragment_reused(self):
+        # Arrange
+        n = self._make()
+        n.serialize()
+        frag = n.getObject()._rt_frag["properties"]
+        
+        # Act
+        n.name = "b"
+        n.serialize()
+        
+        # Assert
+        self.assertIs(n.getObject()._rt_frag["properties"], frag)
+        self.assertEqual(n.getObject()._rt_dirty, set(["name"]))
+    
+    def test_fragment_invalidated(self):
+        # Arrange
+        n = self._make()
+        n.serialize()
+        
+        # Act
+        n.properties.geni.slivers.append(3)
+        result = json.loads(n.serialize())
+        
+        # Assert
+        self.assertEqual(result["properties"]["geni"]["slivers"], [1, 2, 3])
+        self.assertEqual(n.getObject()._rt_dirty, set(["properties"]))
+    
+    def test_serialize_fields(self):
+        # Arrange
+        n = self._make()
+        
+        # Act
+        result = json.loads(n.serialize(fields=["name"]))
+        
+        # Assert
+        self.assertEqual(set(result.keys()), set(["id", "ts", "name"]))
+    
+class ValidatorTest(unittest.TestCase):
+    def test_validator_shared(self):
+        # Arrange
+        a, b = Node({ "id": "1" }), Node({ "id": "2" })
+        
+        # Act
+        a.validate()
+        b.validate()
+        
+        # Assert
+        self.assertIsNotNone(type(a.getObject())._rt_validator)
+        self.assertIs(type(a.getObject())._get_validator(), type(b.getObject())._get_validator())
+    
+    def test_validate_many(self):
+        from jsonschema.exceptions import ValidationError
+        # Arrange
+        good = [Node({ "id": str(i) }) for i in range(10)]
+        bad = Node({ "id": 1234 })
+        
+        # Act
+        validate_many(good)
+        invalid = validate_many(good + [bad], strict=False)
+        
+        # Assert
+        self.assertRaises(ValidationError, validate_many, good + [bad])
+        self.assertEqual(list(invalid), [bad.getObject()])
+        self.assertIsInstance(invalid[bad.getObject()], ValidationError)
+    
+class SchemaCacheTest(unittest.TestCase):
+    def test_lazy_model(self):
+        # Arrange
+        import unis.models
+        
+        # Act
+        result = unis.models.Port
+        
+        # Assert
+        self.assertIn("Port", dir(unis.models))
+        self.assertIs(result, schemaLoader.get_class(SCHEMAS["Port"]))
+        self.assertRaises(AttributeError, getattr, unis.models, "NotAModel")
+    
+    def test_cache_roundtrip(self):
+        import os, tempfile
+        import unis.models.models as models
+        # Arrange
+        path = tempfile.mkdtemp()
+        schemas = copy.deepcopy(models._CACHE)
+        
+        # Act
+        with mock.patch.multiple(models, SCHEMA_CACHE_DIR=path, SCHEMA_CACHE_FILE=os.path.join(path, "schemas.cache")):
+            with mock.patch.dict(models._CACHE, clear=True):
+                models._CACHE.update(schemas)
+                models._save_cache()
+                models._CACHE.clear()
+                models._load_cache()
+                result = dict(models._CACHE)
+        
+        # Assert
+        self.assertEqual(result, schemas)
+        self.assertEqual(os.listdir(path), ["schemas.cache"])
+    
+class IndexTest(unittest.TestCase):
+    def _make(self, key, values):
+        index = Index(key)
+        nodes = [Node({ "id": str(i), "name": v }) for i,v in enumerate(values)]
+        for i, n in enumerate(nodes):
+            index.update(i, n)
+        return index, nodes
+    
+    def test_index_first_slot(self):
+        # Arrange
+        index, nodes = self._make("id", ["a", "b"])
+        
+        # Act
+        result = index.index(nodes[0])
+        
+        # Assert
+        self.assertEqual(result, 0)
+        self.assertEqual(index.index("1"), 1)
+        self.assertIsNone(index.index(Node({ "id": "0" })))
+    
+    def test_subset_range(self):
+        # Arrange
+        index, nodes = self._make("name", ["a", "c", "b", "c", 1])
+        
+        # Act
+        gt, le, eq = index.subset("gt", "a"), index.subset("le", "b"), index.subset("eq", "c")
+        
+        # Assert
+        self.assertEqual(gt, set([1, 2, 3]))
+        self.assertEqual(le, set([0, 2]))
+        self.assertEqual(eq, set([1, 3]))
+        self.assertEqual(index.subset("ge", 0), set([4]))
+    
+    def test_update_moves_key(self):
+        # Arrange
+        index, nodes = self._make("name", ["a", "b", "c"])
+        index.subset("gt", "a")
+        
+        # Act
+        nodes[0].getObject().__dict__["name"] = "d"
+        index.update(0, nodes[0])
+        index.remove(1)
+        
+        # Assert
+        self.assertEqual(index.subset("eq", "a"), set())
+        self.assertEqual(index.subset("gt", "a"), set([0, 2]))
+        self.assertEqual(len(index), 2)
+
+    def test_update_many_keeps_sorted(self):
+        # Arrange
+        index, nodes = self._make("name", ["a", "b", "c", "d", "e", "f", "g", "h"])
+        index.subset("gt", "a")
+        view = index._sorted
+        
+        # Act
+        index.update_many([(8, Node({ "id": "8", "name": "aa" }))])
+        small = index._sorted
+        index.update_many([(i, Node({ "id": str(i), "name": "z" })) for i in range(9, 12)])
+        
+        # Assert
+        self.assertIs(small, view)
+        self.assertIsNone(index._sorted)
+        self.assertEqual(index.subset("gt", "a"), set(range(1, 12)))
+        self.assertEqual(index.subset("lt", "b"), set([0, 8]))
+    
+    def test_dotted_path(self):
+        # Arrange
+        index = Index("properties.geni.client_id")
+        nodes = [Node({ "id": str(i), "properties": { "geni": { "client_id": "c{}".format(i) } } }) for i in range(3)]
+        
+        # Act
+        for i, n in enumerate(nodes):
+            index.update(i, n)
+        
+        # Assert
+        self.assertEqual(index.subset("eq", "c1"), set([1]))
+        self.assertEqual(index.subset("ge", "c1"), set([1, 2]))
+    
+    def test_multi_valued(self):
+        # Arrange
+        index = Index("endpoints")
+        ref = lambda i: { "href": "http://localhost:8888/ports/{}".format(i), "rel": "full" }
+        links = [Link({ "id": str(i), "endpoints": [ref(i), ref(i + 1)] }) for i in range(3)]
+        
+        # Act
+        for i, l in enumerate(links):
+            index.update(i, l)
+        
+        # Assert
+        self.assertEqual(index.subset("eq", "http://localhost:8888/ports/2"), set([1, 2]))
+        self.assertEqual(index.subset("eq", "http://localhost:8888/ports/0"), set([0]))
+    
+    def test_composite(self):
+        # Arrange
+        index = Index(("name", "properties.geni.client_id"))
+        nodes = [Node({ "id": str(i), "name": "n{}".format(i % 2), "properties": { "geni": { "client_id": "c{}".format(i) } } }) for i in range(4)]
+        
+        # Act
+        for i, n in enumerate(nodes):
+            index.update(i, n)
+        
+        # Assert
+        self.assertEqual(index.subset("eq", ("n1", "c3")), set([3]))
+        self.assertEqual(index.subset("eq", ("n0", "c3")), set())
+    
+class QueryTest(unittest.TestCase):
+    def _nodes(self):
+        return [Node({ "id": str(i), "name": "eth{}".format(i % 3), "ts": i }) for i in range(6)]
+    
+    def test_operators(self):
+        # Arrange
+        nodes = self._nodes()
+        
+        # Act
+        q1 = _Query({ "name": { "prefix": "eth1" } })
+        q2 = _Query({ "id": { "in": ["1", "4", 5] } })
+        q3 = _Query({ "ts": { "ne": 2, "lt": 4 } })
+        
+        # Assert
+        self.assertEqual([n.id for n in nodes if q1(n.getObject())], ["1", "4"])
+        self.assertEqual([n.id for n in nodes if q2(n.getObject())], ["1", "4"])
+        self.assertEqual([n.id for n in nodes if q3(n.getObject())], ["0", "1", "3"])
+    
+    def test_plan_most_selective(self):
+        # Arrange
+        nodes = self._nodes()
+        indices = { "name": Index("name"), "ts": Index("ts") }
+        for i, n in enumerate(nodes):
+            indices["name"].update(i, n)
+            indices["ts"].update(i, n)
+        
+        # Act
+        p1 = _Query({ "name": "eth1", "ts": { "gt": 4 } }).plan(indices, len(nodes))
+        p2 = _Query({ "name": "eth1", "ts": { "gt": 0 } }).plan(indices, len(nodes))
+        p3 = _Query({ "ts": { "ne": 1 } }).plan(indices, len(nodes))
+        
+        # Assert
+        self.assertEqual(p1, ("ts", "gt", 4, 1))
+        self.assertEqual(p2, ("name", "eq", "eth1", 2))
+        self.assertEqual(p3[0], None)
+    
+    def test_remote_params(self):
+        # Arrange
+        query = _Query({ "name": "eth0", "capacity": { "gt": 10 }, "address.address": { "prefix": "10.0" },
+                         "id": { "in": ["a1", "a2"] }, "description": "5", "ts": { "gt": "a" } })
+        
+        # Act
+        result = query.params()
+        
+        # Assert
+        self.assertEqual(result, { "name": "eth0", "capacity": "gt=10", "address.address": "reg=%5E10%5C.0", "id": "a1,a2" })
+    
+    def test_estimate_matches_subset(self):
+        # Arrange
+        index = Index("name")
+        for i, n in enumerate(self._nodes()):
+            index.update(i, n)
+        
+        # Act
+        result = [(index.estimate(r, v), len(index.subset(r, v))) for r,v in [("gt", "eth0"), ("le", "eth1"), ("prefix", "eth"), ("in", ["eth0", "eth2"])]]
+        
+        # Assert
+        for estimate, actual in result:
+            self.assertEqual(estimate, actual)
+    
+    def test_pushdown_field_names(self):
+        # Arrange
+        col, calls = _stub_collection(3)
+        col._pushdown, sent = True, []
+        async def get(source=None, ref=None, filters=None, **kwargs):
+            sent.append(filters)
+            return [{ "$schema": SCHEMAS["Node"], "id": "1", "selfRef": "http://u/nodes/1", "source": "a", "ref": "b" }]
+        col._unis.get = get
+        
+        # Act
+        result = list(col.where({ "source": "a", "ref": "b" }))
+        
+        # Assert
+        self.assertEqual(sent, [{ "source": "a", "ref": "b" }])
+        self.assertEqual([Context(v, None).id for v in result], ["1"])
+    
+    def test_pushdown_rejected(self):
+        # Arrange
+        col, calls = _stub_collection(3)
+        get, col._pushdown = col._unis.get, True
+        async def strict(source=None, filters=None, **kwargs):
+            if filters:
+                raise UnisConnectionError("bad request", 400)
+            return await get(source, **kwargs)
+        col._unis.get = strict
+        
+        # Act
+        with self.assertLogs(level="WARNING") as logs:
+            result = list(col.where({ "selfRef": "http://u/nodes/2" }))
+        
+        # Assert
+        self.assertEqual([Context(v, None).id for v in result], ["2"])
+        self.assertIn("filtering locally", logs.output[0])
+    
+    def test_pushdown_error_raised(self):
+        # Arrange
+        col, calls = _stub_collection(3)
+        col._pushdown = True
+        col._unis.get = MagicMock(side_effect=TypeError("broken"))
+        
+        # Act/Assert
+        with self.assertRaises(TypeError):
+            list(col.where({ "selfRef": "http://u/nodes/2" }))
+    
+def _stub_collection(count):
+    col, calls = UnisCollection("nodes", Node), []
+    docs = { str(i): { "$schema": SCHEMAS["Node"], "id": str(i), "selfRef": "http://u/nodes/{}".format(i), "ts": i } for i in range(count) }
+    async def get(source, **kwargs):
+        calls.append(list(kwargs["id"]))
+        return [docs[i] for i in kwargs["id"]]
+    col._unis.get, col._unis.refToUID = get, lambda ref: ("u", ("nodes", ref.split('/')[-1]))
+    col._stubs.update({ ("u", ("nodes", k)): None for k in docs })
+    col._pushdown = False
+    return col, calls
+
+class StreamTest(unittest.TestCase):
+    def _collection(self, count):
+        return _stub_collection(count)
+    
+    def test_stream_pages(self):
+        # Arrange
+        col, calls = self._collection(35)
+        
+        # Act
+        stream = col.stream(prefetch=1)
+        first = next(stream)
+        fetched = len(calls)
+        rest = list(stream)
+        
+        # Assert
+        self.assertEqual(Context(first, None).id, "0")
+        self.assertLess(fetched, 3)
+        self.assertEqual(len(rest), 34)
+        self.assertEqual([len(c) for c in calls], [10, 20, 5])
+        self.assertEqual(col._complete_cache, col._mock)
+    
+    def test_stream_request_order(self):
+        # Arrange
+        col, calls = self._collection(35)
+        get = col._unis.get
+        async def slow_first(source, **kwargs):
+            await asyncio.sleep(0.05 if "0" in kwargs["id"] else 0)
+            return await get(source, **kwargs)
+        col._unis.get = slow_first
+        
+        # Act
+        result = [Context(v, None).id for v in col.stream(prefetch=3)]
+        
+        # Assert
+        self.assertEqual(result, [str(i) for i in range(35)])
+    
+    def test_reported_payload(self):
+        # Arrange
+        col, calls = self._collection(5)
+        get = col._unis.get
+        async def sized(source, **kwargs):
+            return _Payload(await get(source, **kwargs), 4096)
+        col._unis.get = sized
+        
+        # Act
+        col.load()
+        
+        # Assert
+        self.assertEqual(col.stats()["u"]["bytes"], 4096)
+    
+    def test_astream(self):
+        # Arrange
+        col, calls = self._collection(15)
+        async def collect():
+            result = []
+            async for v in col.astream():
+                result.append(v)
+            return result
+        
+        # Act
+        result = col._loop.run_until_complete(collect())
+        
+        # Assert
+        self.assertEqual(sorted(Context(v, None).id for v in result), sorted(str(i) for i in range(15)))
+        self.assertEqual(len(list(col.stream())), 15)
+        self.assertEqual(len(calls), 2)
+    
+    def test_where_streams(self):
+        # Arrange
+        col, calls = self._collection(30)
+        
+        # Act
+        result = [Context(v, None).id for v in col.where({ "ts": { "lt": 3 } })]
+        
+        # Assert
+        self.assertEqual(result, ["0", "1", "2"])
+        self.assertEqual(len(col._cache), 30)
+    
+class EvictionTest(unittest.TestCase):
+    def _collection(self, mode, count, entries):
+        col, calls = _stub_collection(count)
+        col._policy = _Eviction(mode, entries)
+        return col, calls
+    
+    def test_lru_bounds_cache(self):
+        # Arrange
+        col, calls = self._collection("lru", 30, 10)
+        
+        # Act
+        result = col.load()
+        
+        # Assert
+        self.assertEqual(len(result), 30)
+        self.assertEqual(len(col._cache), 10)
+        self.assertEqual(len(col._indices["id"]), 10)
+        self.assertEqual(sum(1 for v in col._stubs.values() if v), 10)
+        self.assertNotEqual(col._complete_cache, col._mock)
+    
+    def test_refetch_evicted(self):
+        # Arrange
+        col, calls = self._collection("lru", 30, 10)
+        col.load()
+        
+        # Act
+        result = col.get(["http://u/nodes/0"])
+        
+        # Assert
+        self.assertEqual(Context(result[0], None).id, "0")
+        self.assertEqual(calls[-1], ["0"])
+        self.assertIsNotNone(col._indices["id"].index("0"))
+        self.assertEqual(len(col._cache), 10)
+    
+    def test_lfu_keeps_frequent(self):
+        # Arrange
+        col, calls = self._collection("lfu", 30, 10)
+        hot = col.get(["http://u/nodes/0"])[0]
+        col.get(["http://u/nodes/0"])
+        
+        # Act
+        col.load()
+        
+        # Assert
+        self.assertIs(col._stubs[("u", ("nodes", "0"))], hot)
+    
+    def test_pending_pinned(self):
+        # Arrange
+        col, calls = self._collection("lru", 30, 10)
+        pinned = col.get(["http://u/nodes/0"])[0]
+        col._pinned = lambda v: v is pinned
+        
+        # Act
+        col.load()
+        
+        # Assert
+        self.assertIs(col._stubs[("u", ("nodes", "0"))], pinned)
+        self.assertEqual(len(col._cache), 10)
+
+    def test_delete_evicted(self):
+        # Arrange
+        col, calls = self._collection("lru", 30, 10)
+        col.load()
+        callbacks = []
+        async def subscribe(sources, cb):
+            callbacks.append(cb)
+        col._subscribe, col._unis.subscribe = True, subscribe
+        asyncio.get_event_loop().run_until_complete(col._add_subscription(["u"]))
+        del calls[:]
+
+        # Act
+        callbacks[0]({ "id": "0", "selfRef": "http://u/nodes/0" }, "DELETE")
+        result = col.load()
+
+        # Assert
+        self.assertEqual(len(result), 29)
+        self.assertEqual(len(col), 29)
+        self.assertNotIn("0", sum(calls, []))
+        self.assertNotIn(("u", ("nodes", "0")), col._stubs)
+
+class SlotMapTest(unittest.TestCase):
+    def test_reuse_slots(self):
+        # Arrange
+        slots = _slotmap()
+        for v in "abcd":
+            slots.add(v)
+        
+        # Act
+        slots.discard(2)
+        slots.discard(1)
+        i = slots.add("e")
+        
+        # Assert
+        self.assertEqual(i, 1)
+        self.assertEqual(len(slots), 3)
+        self.assertEqual(slots.slots(), 4)
+        self.assertEqual(list(slots), ["a", "e", "d"])
+    
+    def test_stub_counts(self):
+        # Arrange
+        col, calls = _stub_collection(30)
+        
+        # Act
+        before = len(col)
+        col.get(["http://u/nodes/3"])
+        
+        # Assert
+        self.assertEqual(before, 30)
+        self.assertEqual(len(col), 30)
+        self.assertEqual(col._stubs.missing, 20)
+    
+    def test_compact_remaps_indices(self):
+        # Arrange
+        col, calls = _stub_collection(30)
+        col._COMPACT = 5
+        col.load()
+        col.createIndex("ts")
+        
+        # Act
+        for i in filter(lambda i: i % 3, range(30)):
+            col._discard(col._indices["id"].index(str(i)))
+        
+        # Assert
+        self.assertEqual(col._cache.slots(), 14)
+        self.assertEqual(len(col._cache), 10)
+        for i in range(0, 30, 3):
+            self.assertEqual(Context(col._cache[col._indices["id"].index(str(i))], None).id, str(i))
+        self.assertEqual([Context(v, None).id for v in col.where({ "ts": { "gt": 20 } })], ["21", "24", "27"])
+    
+class PagerTest(unittest.TestCase):
+    def _converge(self, pager, cost, rounds=30):
+        for _ in range(rounds):
+            count = pager.take()
+            pager.observe(count, cost(count), count * 1000)
+        return pager.stats()["page"]
+    
+    def test_fixed_and_exponential(self):
+        # Arrange
+        fixed, exponential = _Pager("fixed", 10), _Pager("exponential", 10, limit=50)
+        
+        # Act
+        f = [fixed.take() for _ in range(4)]
+        e = [exponential.take() for _ in range(4)]
+        
+        # Assert
+        self.assertEqual(f, [10, 10, 10, 10])
+        self.assertEqual(e, [10, 20, 40, 50])
+    
+    def test_adaptive_latency(self):
+        # Arrange
+        pager = _Pager("adaptive", 10, latency=0.1, payload=10 ** 9)
+        
+        # Act
+        page = self._converge(pager, lambda n: 0.01 + 0.001 * n)
+        
+        # Assert
+        self.assertTrue(60 <= page <= 130, page)
+    
+    def test_adaptive_payload(self):
+        # Arrange
+        pager = _Pager("adaptive", 10, latency=10, payload=50000)
+        
+        # Act
+        page = self._converge(pager, lambda n: 0.001)
+        
+        # Assert
+        self.assertTrue(25 <= page <= 50, page)
+        self.assertEqual(pager.stats()["record_bytes"], 1000)
+    
+    def test_stats_per_source(self):
+        # Arrange
+        col, calls = _stub_collection(30)
+        col._stubs.update({ ("v", ("nodes", k)): None for k in ["a", "b"] })
+        get = col._unis.get
+        async def split(source, **kwargs):
+            if source[0] == "v":
+                return [{ "$schema": SCHEMAS["Node"], "id": i, "selfRef": "http://v/nodes/{}".format(i) } for i in kwargs["id"]]
+            return await get(source, **kwargs)
+        col._unis.get, col._unis.refToUID = split, lambda ref: (ref.split('/')[2], ("nodes", ref.split('/')[-1]))
+        
+        # Act
+        col.load()
+        stats = col.stats()
+        
+        # Assert
+        self.assertEqual(sorted(stats.keys()), ["u", "v"])
+        self.assertEqual(stats["u"]["records"], 30)
+        self.assertEqual(stats["v"]["records"], 2)
+        self.assertEqual(stats["v"]["requests"], 1)
+    
+class AsyncCollectionTest(unittest.TestCase):
+    def test_aload_caller_loop(self):
+        # Arrange
+        col, calls = _stub_collection(25)
+        loop = asyncio.new_event_loop()
+        
+        # Act
+        result = loop.run_until_complete(col.aload())
+        
+        # Assert
+        self.assertEqual(sorted(Context(v, None).id for v in result), sorted(str(i) for i in range(25)))
+        self.assertEqual(col._complete_cache, col._mock)
+        loop.close()
+    
+    def test_aget(self):
+        # Arrange
+        col, calls = _stub_collection(25)
+        loop = asyncio.new_event_loop()
+        
+        # Act
+        result = loop.run_until_complete(col.aget(["http://u/nodes/4", "http://u/nodes/7"]))
+        
+        # Assert
+        self.assertEqual([Context(v, None).id for v in result], ["4", "7"])
+        self.assertEqual(len(calls), 1)
+        loop.close()
+    
+    def test_awhere(self):
+        # Arrange
+        col, calls = _stub_collection(30)
+        loop = asyncio.new_event_loop()
+        
+        # Act
+        streamed = loop.run_until_complete(col.awhere({ "ts": { "gt": 26 } }))
+        indexed = loop.run_until_complete(col.awhere({ "id": "3" }))
+        filtered = loop.run_until_complete(col.awhere(lambda v: Context(v, None).ts < 2))
+        
+        # Assert
+        self.assertEqual(sorted(Context(v, None).id for v in streamed), ["27", "28", "29"])
+        self.assertEqual([Context(v, None).id for v in indexed], ["3"])
+        self.assertEqual(sorted(Context(v, None).id for v in filtered), ["0", "1"])
+        loop.close()
+    
 class CollectionTest(unittest.TestCase):
     def test_init(self):
         # Act
@@ -1,10 +1,16 @@
+import asyncio
+import bson
 import json
 import unittest
 
 from unittest.mock import MagicMock, patch
+from aiohttp import web
 
+from unis.codec import codec, _Codec
+from unis.models import Link
 from unis.rest import UnisProxy
-from unis.rest.unis_client import UnisClient
+from unis.rest.unis_client import UnisClient, _Payload, _PoolStats, _Subscriptions, _decode_stream
+from unis.settings import ConfigurationError
 
 class ProxyTest(unittest.TestCase):
     def _make_n(self, n=1):
@@ -606,3 +612,442 @@ class ClientTest(unittest.TestCase):
         with self.assertRaises(Exception):
             client.delete('#/nodes', {'v': 10})
     
+
+class ClientLimitTest(unittest.TestCase):
+    class _session(object):
+        def __init__(self):
+            self.active, self.peak, self.urls = 0, 0, []
+        def get(self, url, **kwargs):
+            session = self
+            class _request(object):
+                async def __aenter__(self):
+                    session.active += 1
+                    session.peak = max(session.peak, session.active)
+                    session.urls.append(url)
+                    await asyncio.sleep(0.01)
+                    return url
+                async def __aexit__(self, *args):
+                    session.active -= 1
+            return _request()
+    
+    def _client(self, threads, batch):
+        client = object.__new__(UnisClient)
+        client._url, client._verify, client._ssl = "http://localhost:8888", False, None
+        client._threads, client._batch, client._limits = threads, batch, {}
+        client._sessions = { asyncio.get_event_loop(): ClientLimitTest._session() }
+        async def check(resp, read_as_bson=True):
+            return [resp]
+        client._check_response = check
+        return client
+    
+    def test_max_in_flight(self):
+        # Arrange
+        client = self._client(3, 1000)
+        
+        # Act
+        asyncio.get_event_loop().run_until_complete(asyncio.gather(*[client.get("nodes") for _ in range(10)]))
+        
+        # Assert
+        self.assertEqual(len(client._session.urls), 10)
+        self.assertEqual(client._session.peak, 3)
+    
+    def test_batched_ids(self):
+        # Arrange
+        client = self._client(2, 4)
+        ids = [str(i) for i in range(10)]
+        
+        # Act
+        result = asyncio.get_event_loop().run_until_complete(client.get("nodes", id=ids))
+        
+        # Assert
+        self.assertEqual(len(result), 3)
+        self.assertEqual([u.split("id=")[1] for u in client._session.urls], ["0,1,2,3", "4,5,6,7", "8,9"])
+        self.assertEqual(client._session.peak, 2)
+    
+    def test_url_length(self):
+        # Arrange
+        client = self._client(2, 1000)
+        ids = ["x" * 1000 for _ in range(15)]
+        
+        # Act
+        batches = client._batches(ids)
+        
+        # Assert
+        self.assertEqual([len(b) for b in batches], [5, 5, 5])
+
+def _serve(loop, routes):
+    async def start():
+        app = web.Application()
+        for method, path, handler in routes:
+            app.router.add_route(method, path, handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+    return loop.run_until_complete(start())
+
+def _local_client(port, **kwargs):
+    client = object.__new__(UnisClient)
+    client._url, client._verify, client._ssl = "http://127.0.0.1:{}".format(port), False, None
+    client._threads, client._batch, client._limits, client._sessions = 4, 1000, {}, {}
+    client._pool, client._stats = { "size": 4, "keepalive": 30, "dns_ttl": 300 }, _PoolStats()
+    for k, v in kwargs.items():
+        setattr(client, k, v)
+    return client
+
+class ConnectionPoolTest(unittest.TestCase):
+    def _serve(self, loop):
+        async def nodes(request):
+            return web.Response(text=json.dumps([{ "id": "1" }]), content_type="application/perfsonar+json")
+        return _serve(loop, [("GET", "/nodes", nodes)])
+    
+    def _client(self, port, **pool):
+        return _local_client(port, _pool={ "size": 4, "keepalive": 30, "dns_ttl": 300, **pool })
+    
+    def test_reuse(self):
+        # Arrange
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner, port = self._serve(loop)
+        client = self._client(port)
+        
+        # Act
+        for _ in range(5):
+            loop.run_until_complete(client.get("nodes"))
+        stats = client.stats()
+        loop.run_until_complete(client._session.close())
+        loop.run_until_complete(runner.cleanup())
+        
+        # Assert
+        self.assertEqual(stats["requests"], 5)
+        self.assertEqual((stats["new"], stats["reused"]), (1, 4))
+        self.assertEqual(stats["reuse"], 0.8)
+    
+    def test_pool_limit(self):
+        # Arrange
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner, port = self._serve(loop)
+        client = self._client(port, size=2)
+        client._threads = 10
+        
+        # Act
+        loop.run_until_complete(asyncio.gather(*[client.get("nodes") for _ in range(10)]))
+        stats = client.stats()
+        loop.run_until_complete(client._session.close())
+        loop.run_until_complete(runner.cleanup())
+        
+        # Assert
+        self.assertEqual(stats["requests"], 10)
+        self.assertEqual(stats["new"], 2)
+
+class WireFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.loop, self.received, self.queries = asyncio.new_event_loop(), [], []
+        asyncio.set_event_loop(self.loop)
+        docs = [{ "id": str(i), "name": "n" * 50 } for i in range(200)]
+        async def nodes(request):
+            self.received.append(dict(request.headers))
+            self.queries.append(dict(request.query))
+            if "bson" in request.headers.get("Accept", ""):
+                body = bson.dumps({ str(i): d for i,d in enumerate(docs) })
+                return web.Response(body=body, content_type="application/perfsonar+bson")
+            response = web.Response(text=json.dumps(docs), content_type="application/perfsonar+json")
+            if "gzip" in request.headers.get("Accept-Encoding", ""):
+                response.enable_compression()
+            return response
+        async def post(request):
+            self.received.append(dict(request.headers))
+            return web.Response(body=await request.read(), content_type="application/perfsonar+json")
+        async def accepted(request):
+            return web.Response(status=201 if request.method == "POST" else 204)
+        self.runner, self.port = _serve(self.loop, [("GET", "/nodes", nodes), ("POST", "/nodes", post),
+                                                    ("POST", "/links", accepted), ("PUT", "/links/{id}", accepted)])
+        self.docs = docs
+    
+    def tearDown(self):
+        for session in self.client._sessions.values():
+            self.loop.run_until_complete(session.close())
+        self.loop.run_until_complete(self.runner.cleanup())
+    
+    def test_bson(self):
+        # Arrange
+        self.client = _local_client(self.port, _wire="bson")
+        
+        # Act
+        result = self.loop.run_until_complete(self.client.get("nodes"))
+        
+        # Assert
+        self.assertEqual(result, self.docs)
+        self.assertTrue(self.received[0]["Accept"].startswith("application/perfsonar+bson"))
+    
+    def test_streamed_gzip(self):
+        # Arrange
+        self.client = _local_client(self.port, _stream=0)
+        
+        # Act
+        result = self.loop.run_until_complete(self.client.get("nodes"))
+        
+        # Assert
+        self.assertEqual(result, self.docs)
+        self.assertIn("gzip", self.received[0]["Accept-Encoding"])
+    
+    def test_payload_bytes(self):
+        # Arrange
+        self.client = _local_client(self.port, _batch=1)
+        plain = len(json.dumps(self.docs).encode('utf-8'))
+        
+        # Act
+        result = self.loop.run_until_complete(self.client.get("nodes"))
+        batched = self.loop.run_until_complete(self.client.get("nodes", id=["1", "2"]))
+        
+        # Assert
+        self.assertEqual(result, self.docs)
+        self.assertTrue(0 < result.nbytes < plain, result.nbytes)
+        self.assertEqual(len(batched), 2 * len(self.docs))
+        self.assertEqual(batched.nbytes, 2 * result.nbytes)
+    
+    def test_filters(self):
+        # Arrange
+        self.client = _local_client(self.port)
+        proxy = UnisProxy("nodes")
+        proxy.clients = { "u": self.client }
+        filters = { "source": "a", "ref": "b", "collection": "c", "query": "d" }
+        
+        # Act
+        result = self.loop.run_until_complete(proxy.get(filters=filters, limit="5"))
+        
+        # Assert
+        self.assertEqual(result, self.docs)
+        self.assertEqual(self.queries, [{ **filters, "limit": "5" }])
+    
+    def test_status_only_post(self):
+        # Arrange
+        self.client = _local_client(self.port)
+        proxy = UnisProxy("links")
+        proxy.clients = { "u": self.client }
+        links = [Link({ "id": str(i), "selfRef": "http://127.0.0.1:{}/links/{}".format(self.port, i) }).getObject() for i in range(2)]
+        
+        # Act
+        with patch.dict(UnisClient.fqdns, { "127.0.0.1:{}".format(self.port): "u" }):
+            posted = self.loop.run_until_complete(proxy.post(links))
+        
+        # Assert
+        self.assertEqual(posted, [{ "id": "0" }, { "id": "1" }])
+    
+    def test_status_only_patch(self):
+        # Arrange
+        self.client = _local_client(self.port)
+        proxy = UnisProxy("links")
+        proxy.clients = { "u": self.client }
+        links = [Link({ "id": str(i), "selfRef": "http://127.0.0.1:{}/links/{}".format(self.port, i) }).getObject() for i in range(2)]
+        
+        # Act
+        with patch.dict(UnisClient.fqdns, { "127.0.0.1:{}".format(self.port): "u" }):
+            patched = self.loop.run_until_complete(proxy.patch(links, { l: set(["id"]) for l in links }))
+        
+        # Assert
+        self.assertEqual(patched, [{ "id": "0" }, { "id": "1" }])
+    
+    def test_uncompressed(self):
+        # Arrange
+        self.client = _local_client(self.port, _compress=False)
+        
+        # Act
+        result = self.loop.run_until_complete(self.client.get("nodes"))
+        
+        # Assert
+        self.assertEqual(result, self.docs)
+        self.assertEqual(self.received[0]["Accept-Encoding"], "identity")
+    
+    def test_compressed_post(self):
+        # Arrange
+        self.client = _local_client(self.port, _compress_posts=True)
+        
+        # Act
+        result = self.loop.run_until_complete(self.client.post("nodes", json.dumps(self.docs)))
+        
+        # Assert
+        self.assertEqual(result, self.docs)
+        self.assertEqual(self.received[0]["Content-Encoding"], "gzip")
+
+class DecodeStreamTest(unittest.TestCase):
+    class _content(object):
+        def __init__(self, body, size):
+            self._chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        async def read(self, n):
+            return self._chunks.pop(0) if self._chunks else b""
+    
+    def _decode(self, body, size=7):
+        return asyncio.new_event_loop().run_until_complete(_decode_stream(DecodeStreamTest._content(body.encode('utf-8'), size)))
+    
+    def test_array(self):
+        # Arrange
+        docs = [{ "id": str(i), "name": "\u00e9t\u00e9 {}".format(i), "v": [1, 2, { "x": "]" }] } for i in range(20)]
+        
+        # Act
+        result = self._decode(json.dumps(docs))
+        
+        # Assert
+        self.assertEqual(result, docs)
+    
+    def test_object(self):
+        # Act
+        result = self._decode(' { "id": "1" } ')
+        
+        # Assert
+        self.assertEqual(result, { "id": "1" })
+    
+    def test_numbers(self):
+        # Act
+        result = self._decode("[1, 23, 456789]", size=2)
+        
+        # Assert
+        self.assertEqual(result, [1, 23, 456789])
+
+class CodecTest(unittest.TestCase):
+    DOC = { "id": "1", "ts": 1500000000000000, "selfRef": "http://localhost:8888/nodes/1", "name": "été", "v": [1.5, None, True] }
+    
+    def tearDown(self):
+        codec.use("auto")
+    
+    def test_backends(self):
+        for name, backend in _Codec.BACKENDS.items():
+            # Arrange
+            try:
+                backend()
+            except ImportError:
+                continue
+            codec.use(name)
+            
+            # Act
+            text = codec.dumps(self.DOC)
+            
+            # Assert
+            self.assertIsInstance(text, str)
+            self.assertEqual(json.loads(text), self.DOC)
+            self.assertEqual(codec.loads(text.encode('utf-8')), self.DOC)
+            self.assertEqual(codec.loads(text), self.DOC)
+    
+    def test_auto_prefers_installed(self):
+        # Arrange
+        installed = []
+        for name, backend in _Codec.BACKENDS.items():
+            try:
+                backend()
+                installed.append(name)
+            except ImportError:
+                pass
+        
+        # Act
+        name = codec.use("auto")
+        
+        # Assert
+        self.assertEqual(name, installed[0])
+    
+    def test_large_int_falls_back(self):
+        # Arrange
+        codec.use("auto")
+        
+        # Act
+        text = codec.dumps({ "v": 2 ** 70 })
+        
+        # Assert
+        self.assertEqual(json.loads(text), { "v": 2 ** 70 })
+    
+    def test_unknown(self):
+        # Act/Assert
+        with self.assertRaises(ConfigurationError):
+            codec.use("yaml")
+
+class SubscriptionTest(unittest.TestCase):
+    def _serve(self, loop, queries, backfill):
+        connections = []
+        async def subscribe(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            connections.append(ws)
+            async for msg in ws:
+                queries.append((len(connections), json.loads(msg.data)))
+                if len(connections) == 1:
+                    await ws.send_str(json.dumps({ "headers": { "collection": "nodes", "action": "POST" },
+                                                   "data": { "id": "1", "ts": 4102444800000000 } }))
+                    await ws.close()
+            return ws
+        async def nodes(request):
+            backfill.append(request.query.get("ts", None))
+            return web.Response(text=json.dumps([{ "id": "2", "ts": 200 }]), content_type="application/perfsonar+json")
+        return _serve(loop, [("GET", "/subscribe/nodes", subscribe), ("GET", "/nodes", nodes)])
+    
+    def _wait(self, loop, until):
+        async def wait():
+            for _ in range(100):
+                if until():
+                    return
+                await asyncio.sleep(0.02)
+        loop.run_until_complete(wait())
+    
+    def test_reconnect_backfill(self):
+        # Arrange
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        queries, backfill, events = [], [], []
+        runner, port = self._serve(loop, queries, backfill)
+        client = _local_client(port)
+        client._subs = _Subscriptions(client, loop, 0.01, 0.05, 1)
+        
+        # Act
+        client._subs._add("nodes", lambda v, action: events.append((v["id"], action)))
+        self._wait(loop, lambda: len(events) == 2)
+        client._subs._close()
+        loop.run_until_complete(asyncio.sleep(0.05))
+        loop.run_until_complete(client._session.close())
+        loop.run_until_complete(runner.cleanup())
+        
+        # Assert
+        self.assertEqual(events, [("1", "POST"), ("2", "POST")])
+        self.assertEqual([q for _,q in queries], [{ "query": {}, "resourceType": "nodes" }] * 2)
+        self.assertEqual([c for c,_ in queries], [1, 2])
+        self.assertEqual(backfill, ["gt=4102444800000000"])
+        self.assertEqual(client._subs.connects, 2)
+    
+    def test_backoff_until_available(self):
+        # Arrange
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        attempts = []
+        client = _local_client(1)
+        async def connect():
+            attempts.append(loop.time())
+            raise OSError("Connection refused")
+        client._connect = connect
+        client._subs = _Subscriptions(client, loop, 0.01, 0.04, 1)
+        
+        # Act
+        client._subs._add("nodes", lambda v, action: None)
+        self._wait(loop, lambda: len(attempts) >= 5)
+        client._subs._close()
+        loop.run_until_complete(asyncio.sleep(0.01))
+        
+        # Assert
+        self.assertGreaterEqual(client._subs.errors, 5)
+        self.assertEqual(client._subs.connects, 0)
+        self.assertTrue(client._subs._task.done())
+    
+    def test_callback_error_isolated(self):
+        # Arrange
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        subs, events = _Subscriptions(MagicMock(), loop), []
+        def bad(v, action):
+            raise ValueError("bad")
+        subs._channels["nodes"] = [bad, lambda v, action: events.append(v)]
+        
+        # Act
+        subs._dispatch("nodes", { "id": "1", "ts": 5 }, "POST")
+        subs._dispatch("data/1", { "data/1": [{ "ts": 7, "value": 1 }, { "ts": 9, "value": 2 }] }, "POST")
+        
+        # Assert
+        self.assertEqual(events, [{ "id": "1", "ts": 5 }])
+        self.assertEqual(subs._seen, { "nodes": 5, "data/1": 9 })
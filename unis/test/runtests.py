@@ -24,11 +24,34 @@ RUN_INTEGRATION_TESTING = False
 UNIT_TEST_MODULES = [
     'unis.test.rest.ProxyTest',
     'unis.test.rest.ClientTest',
+    'unis.test.rest.ClientLimitTest',
+    'unis.test.rest.ConnectionPoolTest',
+    'unis.test.rest.WireFormatTest',
+    'unis.test.rest.DecodeStreamTest',
+    'unis.test.rest.CodecTest',
+    'unis.test.rest.SubscriptionTest',
     'unis.test.models.UnisObjectTest',
+    'unis.test.models.LazyObjectTest',
     'unis.test.models.ContextTest',
+    'unis.test.models.SerializeTest',
+    'unis.test.models.ValidatorTest',
+    'unis.test.models.SchemaCacheTest',
+    'unis.test.models.IndexTest',
+    'unis.test.models.QueryTest',
+    'unis.test.models.StreamTest',
+    'unis.test.models.EvictionTest',
+    'unis.test.models.SlotMapTest',
+    'unis.test.models.PagerTest',
+    'unis.test.models.AsyncCollectionTest',
     'unis.test.models.CollectionTest',
     'unis.test.runtime.UnisServiceTest',
     'unis.test.runtime.OALTest',
+    'unis.test.runtime.PrefetchTest',
+    'unis.test.runtime.WriteBehindTest',
+    'unis.test.runtime.RetryTest',
+    'unis.test.runtime.InsertManyTest',
+    'unis.test.runtime.AsyncRuntimeTest',
+    'unis.test.runtime.PartialUpdateTest',
     'unis.test.runtime.RuntimeTest'
 ]
 
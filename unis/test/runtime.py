@@ -17,8 +17,12 @@
 UNIS model related tests
 """
 
+import asyncio
+import concurrent.futures
+import contextlib
 import copy
 import json
+import time
 import unittest
 import unittest.mock as mock
 from unittest.mock import MagicMock, patch
@@ -26,11 +30,14 @@ import unis
 import unis.runtime
 import unis.runtime.oal
 
-from unis.models import Node
-from unis.models.settings import SCHEMAS
+from unis.models import Link, Node, Port
+from unis.models.lists import UnisCollection
+from unis.models.models import Context
+from unis.settings import SCHEMAS
 from unis.services import RuntimeService
+from unis.rest.unis_client import ConnectionError as UnisConnectionError
 from unis.runtime.oal import ObjectLayer
-from unis.runtime import Runtime
+from unis.runtime import AsyncRuntime, Runtime
 
 class _RuntimeSettings(object):
     def __init__(self):
@@ -200,3 +207,479 @@ class OALTest(unittest.TestCase):
         a_mock.called_once_with(n)
         p_mock.assert_called_with([n])
         ui_mock.assert_called_with(n)
+
+class _LayerTest(unittest.TestCase):
+    """
+    ObjectLayer over local nodes, ports and links collections.  Fetches are
+    served from `docs`, pushes are echoed back through `respond`, and both are
+    recorded on the test along with resource events.
+    """
+    MODELS = [("nodes", Node), ("ports", Port), ("links", Link)]
+    def _layer(self, docs=None, respond=None, **proxy):
+        self.gets, self.posts, self.events = [], [], []
+        rt, docs = MagicMock(), docs or {}
+        rt.settings = { "proxy": { "defer_update": True, **proxy }, "cache": {}, "default_source": "http://u" }
+        oal = ObjectLayer(rt)
+        for name, model in self.MODELS:
+            col = UnisCollection(name, model)
+            col._pinned, col._lock = oal.pinned, oal._lock
+            col._unis.post, col._unis.refToUID = self._post(respond), lambda ref, full=True: ("u", (ref.split('/')[-2], ref.split('/')[-1]))
+            if name in docs:
+                col._unis.get, col._pushdown = self._get(name, docs[name]), False
+                col._stubs.update({ ("u", (name, k)): None for k in docs[name] })
+            oal._cache[name] = col
+        return oal
+    
+    def _get(self, name, docs):
+        async def get(source, **kwargs):
+            self.gets.append((name, list(kwargs["id"])))
+            return [docs[i] for i in kwargs["id"]]
+        return get
+    def _post(self, respond):
+        async def post(resources):
+            docs = [{ "id": Context(r, None).id, "selfRef": Context(r, None).selfRef } for r in resources]
+            self.posts.append(sorted(d["id"] for d in docs))
+            return respond(len(self.posts), docs) if respond else docs
+        return post
+    
+    def _nodes(self, oal, count):
+        nodes = []
+        for i in range(count):
+            n = Node({ "id": str(i), "selfRef": "http://u/nodes/{}".format(i) })
+            oal._cache["nodes"].append(n.getObject())
+            n.setRuntime(oal)
+            n.addCallback(lambda r, e: self.events.append((r.id, e)))
+            nodes.append(n)
+        return nodes
+    
+    def _wait(self, cond):
+        deadline = time.time() + 2
+        while not cond() and time.time() < deadline:
+            time.sleep(0.01)
+    
+    def _graph(self):
+        ref = lambda c, i: { "href": "http://u/{}/{}".format(c, i) }
+        links = { str(i): { "$schema": SCHEMAS["Link"], "id": str(i), "selfRef": "http://u/links/{}".format(i), "directed": False,
+                            "endpoints": [ref("ports", 2 * i), ref("ports", 2 * i + 1)] } for i in range(5) }
+        ports = { str(i): { "$schema": SCHEMAS["Port"], "id": str(i), "selfRef": "http://u/ports/{}".format(i),
+                            "link": ref("links", i // 2) } for i in range(10) }
+        nodes = { str(i): { "$schema": SCHEMAS["Node"], "id": str(i), "selfRef": "http://u/nodes/{}".format(i),
+                            "ports": [ref("ports", 2 * i), ref("ports", 2 * i + 1)] } for i in range(5) }
+        oal = self._layer({ "nodes": nodes, "ports": ports, "links": links })
+        oal._cache["nodes"].load()
+        del self.gets[:]
+        return oal
+
+class PrefetchTest(_LayerTest):
+    def test_find_many(self):
+        # Arrange
+        oal = self._graph()
+        
+        # Act
+        result = oal.find(["http://u/ports/{}".format(i) for i in range(8)] + ["http://u/links/0"])
+        
+        # Assert
+        self.assertEqual(len(result), 9)
+        self.assertEqual(sorted(self.gets), [("links", ["0", "1", "2", "3", "4"]), ("ports", [str(i) for i in range(10)])])
+    
+    def test_prefetch_paths(self):
+        # Arrange
+        oal = self._graph()
+        nodes = UnisCollection.Context(oal._cache["nodes"], oal)
+        
+        # Act
+        result = list(nodes.where({ "id": { "in": ["0", "1"] } }, prefetch=["ports.link"]))
+        before = len(self.gets)
+        link = result[0].ports[1].link
+        
+        # Assert
+        self.assertEqual([c[0] for c in self.gets], ["ports", "links"])
+        self.assertEqual(link.id, "0")
+        self.assertEqual(len(self.gets), before)
+
+class WriteBehindTest(_LayerTest):
+    def _behind(self, respond=None, **proxy):
+        oal = self._layer(respond=respond, **{ "write_behind": True, "flush_size": 1000, "flush_age": 10, **proxy })
+        return oal, self._nodes(oal, 5)
+    
+    def test_flush_on_size(self):
+        # Arrange
+        oal, nodes = self._behind(flush_size=5, batch=2)
+        
+        # Act
+        for n in nodes:
+            n.name = "updated"
+        self._wait(lambda: len(self.events) == 5)
+        
+        # Assert
+        self.assertEqual(sorted(map(len, self.posts)), [1, 2, 2])
+        self.assertEqual(sorted(self.events), [(str(i), "commit") for i in range(5)])
+        self.assertEqual(oal._pending, set())
+    
+    def test_flush_on_age(self):
+        # Arrange
+        oal, nodes = self._behind(flush_age=0.05)
+        
+        # Act
+        nodes[0].name, nodes[1].name = "a", "b"
+        self._wait(lambda: len(self.events) == 2)
+        
+        # Assert
+        self.assertEqual(self.posts, [["0", "1"]])
+    
+    def test_coalesce(self):
+        # Arrange
+        oal, nodes = self._behind()
+        
+        # Act
+        for v in ["a", "b", "c"]:
+            nodes[0].name = v
+        pending = len(oal._pending)
+        oal.flush()
+        
+        # Assert
+        self.assertEqual(pending, 1)
+        self.assertEqual(self.posts, [["0"]])
+        self.assertEqual(self.events, [("0", "commit")])
+    
+    def test_pinned_until_written(self):
+        # Arrange
+        writing = []
+        oal, nodes = self._behind(lambda attempt, docs: writing.append(oal._cache["nodes"]._pinned(nodes[0].getObject())) or docs)
+        nodes[0].name = "a"
+        oal.flush()
+        
+        # Act
+        nodes[1].name = "b"
+        
+        # Assert
+        self.assertEqual(writing, [True])
+        self.assertFalse(oal._cache["nodes"]._pinned(nodes[0].getObject()))
+        self.assertTrue(oal._cache["nodes"]._pinned(nodes[1].getObject()))
+        self.assertEqual((oal._pending, oal._inflight), (set([nodes[1].getObject()]), set()))
+    
+    def test_failure_reported(self):
+        # Arrange
+        def reject(attempt, docs):
+            raise ValueError("rejected")
+        oal, nodes = self._behind(reject)
+        nodes[0].name = "a"
+        
+        # Act
+        with self.assertRaises(ValueError):
+            oal.flush()
+        
+        # Assert
+        self.assertEqual(self.events, [("0", "error")])
+        self.assertIn("name", nodes[0].getObject()._rt_dirty)
+
+    def test_triggered_failure_logged(self):
+        # Arrange
+        oal, nodes = self._behind(lambda attempt, docs: docs if attempt > 1 else [][0], flush_size=1, flush_age=0.05)
+        
+        # Act
+        with patch.object(unis.runtime.oal.logging, 'getLogger') as log_mock:
+            nodes[0].name = "a"
+            self._wait(lambda: log_mock.return_value.warning.called)
+            failed = concurrent.futures.Future()
+            failed.set_exception(ValueError("rejected"))
+            oal._pending.add(nodes[1].getObject())
+            oal._writer._done(failed)
+            self._wait(lambda: len(self.events) == 2)
+        
+        # Assert
+        self.assertEqual(log_mock.return_value.warning.call_count, 2)
+        self.assertEqual(self.events, [("0", "error"), ("1", "commit")])
+        self.assertEqual(oal._pending, set())
+
+class RetryTest(_LayerTest):
+    def _retry(self, respond, **proxy):
+        oal = self._layer(respond=respond, **{ "retries": 2, "backoff": 0.001, **proxy })
+        nodes = self._nodes(oal, 4)
+        for n in nodes:
+            n.name = "updated"
+        return oal, nodes
+    
+    def test_retry_server_error(self):
+        # Arrange
+        def respond(attempt, docs):
+            if attempt < 3:
+                raise UnisConnectionError("unavailable", 503)
+            return docs
+        oal, nodes = self._retry(respond)
+        
+        # Act
+        oal.flush()
+        
+        # Assert
+        self.assertEqual(len(self.posts), 3)
+        self.assertEqual(sorted(self.events), [(str(i), "commit") for i in range(4)])
+        self.assertEqual(oal._pending, set())
+    
+    def test_requeue_partial(self):
+        # Arrange
+        oal, nodes = self._retry(lambda attempt, docs: [d for d in docs if d["id"] in "02"] if attempt == 1 else docs)
+        
+        # Act
+        oal.flush()
+        
+        # Assert
+        self.assertEqual(self.posts, [["0", "1", "2", "3"], ["1", "3"]])
+        self.assertEqual(sorted(self.events), [(str(i), "commit") for i in range(4)])
+        self.assertEqual(oal._attempts, {})
+    
+    def test_client_error_not_retried(self):
+        # Arrange
+        def respond(attempt, docs):
+            raise UnisConnectionError("bad request", 400)
+        oal, nodes = self._retry(respond)
+        
+        # Act
+        with self.assertRaises(UnisConnectionError):
+            oal.flush()
+        
+        # Assert
+        self.assertEqual(len(self.posts), 1)
+        self.assertEqual(sorted(self.events), [(str(i), "error") for i in range(4)])
+        self.assertIn("name", nodes[0].getObject()._rt_dirty)
+    
+    def test_dead_letter(self):
+        # Arrange
+        dead = []
+        oal, nodes = self._retry(lambda attempt, docs: [d for d in docs if d["id"] != "0"])
+        oal.addDeadLetter(lambda resources, exp: dead.extend(r.id for r in resources))
+        
+        # Act
+        oal.flush()
+        
+        # Assert
+        self.assertEqual(len(self.posts), 3)
+        self.assertEqual(dead, ["0"])
+        self.assertEqual(sorted(self.events), [("0", "error")] + [(str(i), "commit") for i in range(1, 4)])
+        self.assertEqual(oal._pending, set())
+
+    def test_invalid_in_batch(self):
+        # Arrange
+        dead = []
+        oal, nodes = self._retry(None)
+        oal.addDeadLetter(lambda resources, exp: dead.extend((r.id, type(exp).__name__) for r in resources))
+        nodes[2].name = 5
+
+        # Act
+        oal.flush()
+
+        # Assert
+        self.assertEqual(self.posts, [["0", "1", "3"]])
+        self.assertEqual(dead, [("2", "ValidationError")])
+        self.assertEqual(sorted(self.events), [("0", "commit"), ("1", "commit"), ("2", "error"), ("3", "commit")])
+        self.assertEqual((oal._pending, oal._inflight), (set(), set()))
+
+class InsertManyTest(_LayerTest):
+    def test_insert_many(self):
+        # Arrange
+        oal = self._layer(defer_update=False)
+        events = []
+        oal.nodes.addCallback(lambda r, e: events.append((r.id, e)))
+        oal.nodes.createIndex("name")
+        resources = [Node({ "id": str(i), "name": "n{}".format(i % 2) }) for i in range(5)] + [{ "$schema": SCHEMAS["Port"], "id": "p" }]
+        
+        # Act
+        result = oal.insert_many(resources)
+        
+        # Assert
+        self.assertEqual(len(result), 6)
+        self.assertEqual((len(oal.nodes), len(oal.ports)), (5, 1))
+        self.assertEqual(sorted(events), [(str(i), "new") for i in range(5)])
+        self.assertEqual(oal.nodes._indices["name"].subset("eq", "n1"), set([1, 3]))
+        self.assertEqual(self.posts, [])
+    
+    def test_insert_many_existing(self):
+        # Arrange
+        oal = self._layer(defer_update=False)
+        oal.insert_many([Node({ "id": "1", "ts": 1, "selfRef": "http://u/nodes/1" })])
+        
+        # Act
+        result = oal.insert_many([Node({ "id": "1", "ts": 2, "name": "b", "selfRef": "http://u/nodes/1" }), Node({ "id": "2" })])
+        
+        # Assert
+        self.assertEqual(len(oal.nodes), 2)
+        self.assertEqual(Context(result[0], None).name, "b")
+    
+    def test_insert_many_commit(self):
+        # Arrange
+        oal = self._layer(defer_update=False, batch=1000)
+        resources = [Node({ "id": str(i) }) for i in range(5)] + [Port({ "id": "p" })]
+        
+        # Act
+        oal.insert_many(resources, commit=True)
+        
+        # Assert
+        self.assertEqual(sorted(map(len, self.posts)), [1, 5])
+        self.assertEqual(oal._pending, set())
+        self.assertEqual(resources[0].selfRef, "http://u/nodes/0")
+
+    def test_insert_many_callbacks(self):
+        # Arrange
+        oal = self._layer(defer_update=False, batch=1000)
+        ports, sizes = oal._cache["ports"], []
+        extend, ports.append = ports.extend, MagicMock(side_effect=AssertionError)
+        ports.extend = lambda items: sizes.append(len(items)) or extend(items)
+        oal.nodes.addCallback(lambda r, e: oal.insert(Port({ "id": "p" + r.id }), commit=True))
+
+        # Act
+        oal.insert_many([Node({ "id": str(i) }) for i in range(5)])
+
+        # Assert
+        self.assertEqual(sizes, [5])
+        self.assertEqual(len(oal.ports), 5)
+        self.assertEqual(self.posts, [["p0", "p1", "p2", "p3", "p4"]])
+
+class AsyncRuntimeTest(_LayerTest):
+    def _async(self):
+        oal = self._layer(defer_update=False)
+        n = self._nodes(oal, 1)[0]
+        oal._cache["nodes"] = UnisCollection.Context(oal._cache["nodes"], oal)
+        return oal, n
+    
+    def test_update_in_running_loop(self):
+        # Arrange
+        oal, n = self._async()
+        async def run():
+            n.name = "updated"
+            scheduled = len(oal._tasks)
+            await oal.aflush()
+            return scheduled, await oal.afind("http://u/nodes/0")
+        
+        # Act
+        scheduled, found = asyncio.new_event_loop().run_until_complete(run())
+        
+        # Assert
+        self.assertEqual(scheduled, 1)
+        self.assertEqual(self.posts, [["0"]])
+        self.assertEqual(found, [n.getObject()])
+        self.assertEqual(oal._tasks, set())
+    
+    def _connect(self, oal, close=None):
+        async def add(layer, hrefs):
+            layer._cache["nodes"] = oal._cache["nodes"]
+        async def nothing(layer, *args):
+            pass
+        stack = contextlib.ExitStack()
+        for name, fn in [("aaddSources", add), ("apreload", nothing), ("ashutdown", close or nothing)]:
+            stack.enter_context(patch.object(ObjectLayer, name, fn))
+        return stack
+    
+    def test_start(self):
+        # Arrange
+        oal, n = self._async()
+        async def run():
+            async with AsyncRuntime("http://u") as rt:
+                return rt.nodes, await rt.nodes.where({ "id": "0" }), await rt.find("http://u/nodes/0")
+        
+        # Act
+        with self._connect(oal):
+            nodes, where, found = asyncio.new_event_loop().run_until_complete(run())
+        
+        # Assert
+        self.assertIsInstance(nodes, UnisCollection.AsyncContext)
+        self.assertEqual([v.id for v in where], ["0"])
+        self.assertEqual(found, [n.getObject()])
+    
+    def test_collection_sync_access(self):
+        # Arrange
+        oal, n = self._async()
+        async def run():
+            async with AsyncRuntime("http://u") as rt:
+                with self.assertRaises(TypeError):
+                    list(rt.nodes)
+                with self.assertRaises(TypeError):
+                    rt.nodes[0]
+                return [v.id async for v in rt.nodes]
+        
+        # Act
+        with self._connect(oal):
+            ids = asyncio.new_event_loop().run_until_complete(run())
+        
+        # Assert
+        self.assertEqual(ids, ["0"])
+    
+    def test_reference_in_running_loop(self):
+        # Arrange
+        oal = self._graph()
+        node = Context(oal._cache["nodes"][0], oal)
+        async def run():
+            with self.assertRaisesRegex(RuntimeError, "awaitables"):
+                node.ports[0].id
+            await oal.aprefetch(node, "ports")
+            return node.ports[0].id
+        
+        # Act
+        port = asyncio.new_event_loop().run_until_complete(run())
+        
+        # Assert
+        self.assertEqual(port, "0")
+        self.assertEqual([c[0] for c in self.gets], ["ports"])
+    
+    def test_sync_shutdown(self):
+        # Arrange
+        oal, n = self._async()
+        closed = []
+        async def close(layer):
+            closed.append(layer)
+        
+        # Act
+        with self._connect(oal, close), patch("unis.runtime.runtime.atexit") as hook:
+            rt = asyncio.new_event_loop().run_until_complete(AsyncRuntime("http://u").start())
+            hook.register.call_args[0][0]()
+        
+        # Assert
+        self.assertEqual(len(closed), 1)
+        self.assertIsNone(rt._oal)
+        hook.unregister.assert_called_once_with(rt.shutdown)
+        with self.assertRaises(TypeError):
+            with rt:
+                pass
+
+class PartialUpdateTest(_LayerTest):
+    def _partial(self):
+        oal, sent = self._layer(partial_update=True), []
+        def send(method):
+            async def _send(href, data):
+                doc = json.loads(data)
+                sent.append((method, href, doc))
+                return [{ "id": d["id"], "selfRef": "http://u/nodes/{}".format(d["id"]) } for d in (doc if isinstance(doc, list) else [doc])]
+            return _send
+        unis = oal._cache["nodes"]._unis
+        del unis.post
+        unis.clients = { "u": MagicMock(post=send("POST"), put=send("PUT")) }
+        return oal, sent
+    
+    def test_new_resource_posted_whole(self):
+        # Arrange
+        oal, sent = self._partial()
+        n = oal.insert(Node({ "id": "new", "name": "a", "properties": { "k": "v" } }))
+        
+        # Act
+        n.commit(publish_to="http://u")
+        oal.flush()
+        n.name = "b"
+        oal.flush()
+        
+        # Assert
+        self.assertEqual([(m, h) for m,h,_ in sent], [("POST", "nodes"), ("PUT", "nodes/new")])
+        self.assertEqual((sent[0][2][0]["name"], sent[0][2][0]["properties"]), ("a", { "k": "v" }))
+        self.assertEqual(sorted(sent[1][2].keys()), ["id", "name", "ts"])
+    
+    def test_stored_resource_patched(self):
+        # Arrange
+        oal, sent = self._partial()
+        n = self._nodes(oal, 1)[0]
+        
+        # Act
+        n.name = "b"
+        oal.flush()
+        
+        # Assert
+        self.assertEqual([(m, h) for m,h,_ in sent], [("PUT", "nodes/0")])
+        self.assertEqual(sent[0][2]["name"], "b")
+        self.assertNotIn("$schema", sent[0][2])
@@ -1,50 +1,284 @@
 import bisect
-import functools
+import itertools
+import math
 
 from lace.logging import trace
 
 from unis.utils.pubsub import Events
-from unis.models.models import UnisObject
+from unis.models.models import Context, List, Local, Primitive, UnisObject, _unistype
+
+class _SortedList(object):
+    """
+    Sorted list stored as a list of bounded buckets, giving logarithmic
+    search and near logarithmic insertion and removal.
+    """
+    _LOAD = 500
+    def __init__(self, values=None):
+        values = sorted(values or [])
+        self._lists = [values[i:i + self._LOAD] for i in range(0, len(values), self._LOAD)]
+        self._maxes = [ls[-1] for ls in self._lists]
+
+    def add(self, v):
+        if not self._maxes:
+            self._lists.append([v])
+            self._maxes.append(v)
+            return
+        i = bisect.bisect_left(self._maxes, v)
+        if i == len(self._maxes):
+            i -= 1
+            self._lists[i].append(v)
+            self._maxes[i] = v
+        else:
+            bisect.insort(self._lists[i], v)
+        if len(self._lists[i]) > 2 * self._LOAD:
+            ls = self._lists[i]
+            self._lists[i:i + 1] = [ls[:self._LOAD], ls[self._LOAD:]]
+            self._maxes[i:i + 1] = [ls[self._LOAD - 1], ls[-1]]
+
+    def remove(self, v):
+        i = bisect.bisect_left(self._maxes, v)
+        if i == len(self._maxes):
+            raise ValueError("{} not in list".format(v))
+        ls = self._lists[i]
+        j = bisect.bisect_left(ls, v)
+        if ls[j] != v:
+            raise ValueError("{} not in list".format(v))
+        del ls[j]
+        if ls:
+            self._maxes[i] = ls[-1]
+        else:
+            del self._lists[i], self._maxes[i]
+
+    def irange(self, v):
+        i = bisect.bisect_left(self._maxes, v)
+        if i < len(self._lists):
+            yield from self._lists[i][bisect.bisect_left(self._lists[i], v):]
+            for ls in self._lists[i + 1:]:
+                yield from ls
+
+    def rank(self, v):
+        i = bisect.bisect_left(self._maxes, v)
+        if i == len(self._lists):
+            return len(self)
+        return sum(map(len, self._lists[:i])) + bisect.bisect_left(self._lists[i], v)
+
+    def __len__(self):
+        return sum(map(len, self._lists))
+
+class _Keys(tuple):
+    """ Keys of a resource in a multi-valued index """
+
+_missing = object()
+def _expand(values):
+    for v in values:
+        if isinstance(v, List):
+            yield from v._rt_ls
+        elif isinstance(v, list):
+            yield from v
+        else:
+            yield v
+def _normalize(v):
+    if isinstance(v, Primitive):
+        return v._rt_raw
+    elif isinstance(v, UnisObject):
+        return v.__dict__.get('selfRef', None)
+    elif isinstance(v, dict) and 'href' in v:
+        return v['href']
+    return v
+
+def children(values, n):
+    """ Values found under `n` in each of `values`, with lists expanded """
+    step = []
+    for v in _expand(values):
+        if isinstance(v, (UnisObject, Local)):
+            v = v.__dict__.get(n, _missing)
+        elif isinstance(v, dict):
+            v = v.get(n, _missing)
+        else:
+            continue
+        if v is not _missing:
+            step.append(v)
+    return list(_expand(step))
+
+def resolver(path):
+    """
+    Build a function returning every value found at a dotted path,
+    following lists and using the href of referenced resources.
+    """
+    parts = path.split('.') if isinstance(path, str) else list(path)
+    def _resolve(obj):
+        obj = obj.getObject() if isinstance(obj, Context) else obj
+        if len(parts) == 1:
+            v = obj.__dict__.get(parts[0], _missing)
+            if v is _missing:
+                return ()
+            elif isinstance(v, Primitive):
+                return (v._rt_raw,)
+            elif not isinstance(v, (_unistype, list, dict)):
+                return (v,)
+        values = [obj]
+        for n in parts:
+            values = children(values, n)
+        return [_normalize(v) for v in values]
+    return _resolve
+
+def resolve(obj, path):
+    return resolver(path)(obj)
 
 class Index(object):
+    _ORDERED, _RANGES, _REBUILD = (int, float, str, bytes), ["gt", "ge", "lt", "le", "prefix"], 0.25
     @trace.debug("Index")
     def __init__(self, key):
         self.key = key
-        self._keys, self._indices, self._items = [], [], []
-    
+        self._resolvers = [resolver(k) for k in (key if isinstance(key, tuple) else (key,))]
+        self._eq, self._rev, self._sorted = {}, {}, None
+
     @trace.info("Index")
     def index(self, item):
-        try:
-            v = getattr(item, self.key) if isinstance(item, UnisObject) else item
-        except AttributeError:
+        if isinstance(item, (Context, UnisObject)):
+            item = item.getObject() if isinstance(item, Context) else item
+            ref = _normalize(item.__dict__.get('selfRef', None))
+            for k in self._iter(self._keys(item)):
+                for i in self._find(k):
+                    other = self._rev[i][1]
+                    if other is item or (ref and _normalize(other.__dict__.get('selfRef', None)) == ref):
+                        return i
             return None
-        s = bisect.bisect_left(self._keys, v)
-        
-        for i in range(s, len(self._keys)):
-            a, b = self._items[i], item
-            if a.getObject() == b.getObject() or getattr(a, 'selfRef', True) == getattr(b, 'selfRef', False):
-                return self._indices[i]
-    
+        return next(iter(self._find(item)), None)
+
     @trace.info("Index")
     def subset(self, rel, v):
-        slices = {
-            "gt": lambda: set(self._indices[bisect.bisect_right(self._keys, v):]),
-            "ge": lambda: set(self._indices[bisect.bisect_left(self._keys, v):]),
-            "lt": lambda: set(self._indices[:bisect_left(self._keys, v)]),
-            "le": lambda: set(self._indices[:bisect_right(self._keys, v)]),
-            "eq": lambda: set(self._indices[bisect.bisect_left(self._keys, v):bisect.bisect_right(self._keys, v)])
-        }
-        return slices[rel]()
-        
+        if rel == "eq":
+            return set(self._find(v))
+        elif rel == "in":
+            return set(itertools.chain(*[self._find(x) for x in v]))
+        elif rel not in self._RANGES:
+            raise ValueError("Relation cannot be answered by an index - {}".format(rel))
+        if not self._ranged(rel, v):
+            return set()
+        ty = type(v).__name__
+        if rel in ["gt", "ge"]:
+            entries = self._sorted.irange((ty, v, math.inf) if rel == "gt" else (ty, v))
+            cmp = lambda e: True
+        elif rel in ["lt", "le"]:
+            entries = self._sorted.irange((ty,))
+            cmp = (lambda e: e[1] < v) if rel == "lt" else (lambda e: e[1] <= v)
+        else:
+            entries = self._sorted.irange((ty, v))
+            cmp = lambda e: e[1].startswith(v)
+        return set(e[2] for e in itertools.takewhile(lambda e: e[0] == ty and cmp(e), entries))
+
+    @trace.info("Index")
+    def estimate(self, rel, v):
+        if rel == "eq":
+            try:
+                slot = self._eq.get(v, None)
+            except TypeError:
+                return 0
+            return 0 if slot is None else (len(slot) if isinstance(slot, set) else 1)
+        elif rel == "in":
+            return sum(self.estimate("eq", x) for x in v)
+        elif rel not in self._RANGES:
+            return len(self)
+        if not self._ranged(rel, v):
+            return 0
+        ty = type(v).__name__
+        start, end = self._sorted.rank((ty,)), self._sorted.rank((ty + "\0",))
+        if rel == "gt":
+            return end - self._sorted.rank((ty, v, math.inf))
+        elif rel == "ge":
+            return end - self._sorted.rank((ty, v))
+        elif rel == "lt":
+            return self._sorted.rank((ty, v)) - start
+        elif rel == "le":
+            return self._sorted.rank((ty, v, math.inf)) - start
+        top = v + ("\U0010ffff" if isinstance(v, str) else b"\xff")
+        return self._sorted.rank((ty, top)) - self._sorted.rank((ty, v))
+
     @trace.info("Index")
     def update(self, index, item):
-        i = functools.reduce(lambda a,b: b if b == index else a, self._indices, None)
-        if i:
-            self._keys.pop(i)
-            self._indices.pop(i)
-            self._items.pop(i)
-        key = getattr(item, self.key, None)
-        i = bisect.bisect_left(self._keys, key)
-        self._keys.insert(i, key)
-        self._indices.insert(i, index)
-        self._items.insert(i, item)
+        self.remove(index)
+        if item is None:
+            return
+        item = item.getObject() if isinstance(item, Context) else item
+        keys = self._keys(item)
+        self._rev[index] = (keys, item)
+        for k in self._iter(keys):
+            try:
+                slot = self._eq.get(k, None)
+                if slot is None:
+                    self._eq[k] = index
+                elif isinstance(slot, set):
+                    slot.add(index)
+                elif slot != index:
+                    self._eq[k] = set([slot, index])
+            except TypeError:
+                pass
+            if self._sorted is not None and isinstance(k, self._ORDERED):
+                self._sorted.add(self._entry(k, index))
+
+    @trace.info("Index")
+    def update_many(self, items):
+        # Small batches go into the sorted view like single updates, large ones
+        # drop it to be rebuilt once on the next ranged query
+        items = list(items)
+        if len(items) > len(self) * self._REBUILD:
+            self._sorted = None
+        for index, item in items:
+            self.update(index, item)
+    
+    @trace.info("Index")
+    def remove(self, index):
+        if index not in self._rev:
+            return
+        for k in self._iter(self._rev.pop(index)[0]):
+            try:
+                slot = self._eq.get(k, None)
+                if isinstance(slot, set):
+                    slot.discard(index)
+                    if len(slot) == 1:
+                        self._eq[k] = slot.pop()
+                elif slot == index:
+                    del self._eq[k]
+            except TypeError:
+                pass
+            if self._sorted is not None and isinstance(k, self._ORDERED):
+                try:
+                    self._sorted.remove(self._entry(k, index))
+                except ValueError:
+                    pass
+
+    @trace.info("Index")
+    def remap(self, mapping):
+        self._rev = { mapping[i]: v for i,v in self._rev.items() }
+        for k, slot in self._eq.items():
+            self._eq[k] = set(mapping[i] for i in slot) if isinstance(slot, set) else mapping[slot]
+        self._sorted = None
+
+    def _keys(self, item):
+        if len(self._resolvers) == 1:
+            keys = self._resolvers[0](item)
+        else:
+            keys = list(itertools.product(*[r(item) for r in self._resolvers]))
+        return keys[0] if len(keys) == 1 else _Keys(keys)
+    def _ranged(self, rel, v):
+        if not isinstance(v, self._ORDERED) or (rel == "prefix" and not isinstance(v, (str, bytes))):
+            return False
+        if self._sorted is None:
+            entries = [self._entry(k, i) for i,(ks,_) in self._rev.items() for k in self._iter(ks) if isinstance(k, self._ORDERED)]
+            self._sorted = _SortedList(entries)
+        return True
+    def _iter(self, keys):
+        return keys if isinstance(keys, _Keys) else (keys,)
+    def _entry(self, k, index):
+        return (type(k).__name__, k, index)
+    def _find(self, v):
+        try:
+            slot = self._eq.get(v, None)
+        except TypeError:
+            return []
+        slot = [] if slot is None else (sorted(slot) if isinstance(slot, set) else [slot])
+        return [i for i in slot if any(type(k) is type(v) for k in self._iter(self._rev[i][0]) if k == v)]
+
+    def __len__(self):
+        return len(self._rev)
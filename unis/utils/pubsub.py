@@ -4,3 +4,5 @@ class Events(Enum):
     new = 1
     update = 2
     delete = 3
+    commit = 4
+    error = 5